@@ -113,6 +113,24 @@ for qname, qtype, timeout in tqdm(test_cases, desc="Running Tests"):
         failed_tests += 1
     print("-" * 40)
 
+# Batch mode, with a name given without its trailing dot
+print("Running test: --batch example.com A")
+result = subprocess.run(
+    CLIENT_CMD.format('--batch', '-', TIMEOUT).split(),
+    input="example.com A\n", capture_output=True, text=True, timeout=TIMEOUT * 3 + 10
+)
+expected_output = normalize_output(expected_outputs["example.com. A"])
+actual_output = normalize_output(parse_output(result.stdout))
+print(f"Expected Output:\n{expected_output}")
+print(f"Actual Output:\n{actual_output}")
+if expected_output in actual_output:
+    print("Test Passed!")
+    passed_tests += 1
+else:
+    print("Test Failed!")
+    failed_tests += 1
+print("-" * 40)
+
 # Terminate the server
 server_proc.terminate()
 
@@ -0,0 +1,333 @@
+#! /usr/bin/env python3
+
+"""
+    Microbenchmarks for the DNS server internals
+    Python 3
+    Usage: python3 benchmark.py [benchmark ...]
+    coding: utf-8
+
+    Notes:
+        Run every benchmark with:
+            python3 benchmark.py
+        Or only some of them, e.g.:
+            python3 benchmark.py nameservers
+
+    Author: Fai Chan (z5411219)
+"""
+from io import BytesIO
+import random
+import struct
+import sys
+import timeit
+import tracemalloc
+
+from classes import (
+    DNSHeader,
+    DNSQuestion,
+    DNSRecord,
+    DNSResponse,
+    FLAG_RESPONSE,
+    TYPE_A,
+    TYPE_NS,
+    MAX_POINTER,
+    encode_name,
+    name_encoding,
+)
+from server import DNSCache, NameserverIndex
+
+
+def report(name: str, seconds: float, iterations: int) -> None:
+    print(f"{name:<40} {seconds / iterations * 1e6:>10.2f} us/op")
+
+
+def linear_closest_nameservers(cache: DNSCache, qname: str):
+    # the ancestor-by-ancestor lookup find_closest_nameservers used before NameserverIndex
+    ancestor_parts = qname.split(".")
+
+    while ancestor_parts:
+        ancestor = ".".join(ancestor_parts)
+        ancestor = ancestor if ancestor else "."  # root domain
+
+        resolve_ns = cache.get_records(ancestor, "NS")
+        if resolve_ns:
+            return [
+                DNSRecord(name=ancestor, type_=TYPE_NS, data=ns) for ns in resolve_ns
+            ]
+
+        ancestor_parts = ancestor_parts[1:]
+
+    return []
+
+
+def bench_nameservers(zones: int = 100_000, depth: int = 12, iterations: int = 20_000):
+    """
+    Closest-delegation lookups for deep names in a zone with many delegations.
+    """
+    rng = random.Random(3331)
+    cache = DNSCache()
+    cache.add_record(".", "NS", "a.root-servers.net.")
+    zone_names = []
+    for i in range(zones):
+        zone = f"zone{i}.tld{i % 50}."
+        cache.add_record(zone, "NS", f"ns1.{zone}")
+        cache.add_record(zone, "NS", f"ns2.{zone}")
+        zone_names.append(zone)
+
+    labels = ".".join(f"l{i}" for i in range(depth))
+    queries = [f"{labels}.{rng.choice(zone_names)}" for _ in range(1000)]
+    # names outside every zone walk all the way up to the root
+    queries += [f"{labels}.nowhere{i}.invalid." for i in range(100)]
+
+    index = NameserverIndex()
+    index.build(cache)
+    for qname in queries:
+        assert index.find(qname) == linear_closest_nameservers(cache, qname)
+
+    rounds = max(1, iterations // len(queries))
+    print(f"nameservers: {zones} delegations, {depth + 2}-label names")
+    seconds = timeit.timeit(
+        lambda: [linear_closest_nameservers(cache, q) for q in queries], number=rounds
+    )
+    report("ancestor join + lookup", seconds, rounds * len(queries))
+    seconds = timeit.timeit(lambda: [index.find(q) for q in queries], number=rounds)
+    report("reversed-label trie", seconds, rounds * len(queries))
+
+
+def synthetic_zone(zones: int):
+    # roughly what a large zone looks like: delegations with glue, hosts and aliases
+    for i in range(zones):
+        zone = f"zone{i}.tld{i % 50}."
+        yield zone, "NS", f"ns1.{zone}"
+        yield zone, "NS", f"ns2.{zone}"
+        yield f"ns1.{zone}", "A", f"10.{i % 256}.{i // 256 % 256}.1"
+        yield f"ns2.{zone}", "A", f"10.{i % 256}.{i // 256 % 256}.2"
+        yield f"www.{zone}", "A", f"192.0.{i % 256}.{i // 256 % 256}"
+        yield f"alias.{zone}", "CNAME", f"www.{zone}"
+
+
+def bench_cache(zones: int = 50_000):
+    """
+    Memory held by the zone store, the old dict of dicts of lists vs DNSCache.
+    """
+    # the records are generated inside each measurement, like reading the master file
+    tracemalloc.start()
+    legacy = {}
+    for qname, qtype, record in synthetic_zone(zones):
+        # the structure DNSCache used before ZoneEntry
+        legacy.setdefault(qname.lower(), {}).setdefault(qtype, []).append(record)
+    legacy_bytes = tracemalloc.get_traced_memory()[0]
+    del legacy
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    cache = DNSCache()
+    for qname, qtype, record in synthetic_zone(zones):
+        cache.add_record(qname, qtype, record)
+    compact_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    usage = cache.memory_usage()
+    print(f"cache: {usage['records']} records")
+    print(
+        f"{'dict of dicts of lists':<40} {legacy_bytes / usage['records']:>10.1f} B/record"
+    )
+    print(
+        f"{'DNSCache (ZoneEntry)':<40} {compact_bytes / usage['records']:>10.1f} B/record"
+    )
+    print(
+        f"{'DNSCache.memory_usage()':<40} {usage['bytes_per_record']:>10.1f} B/record"
+    )
+
+
+def compress_name(name: str, offset: int, suffixes: dict) -> bytes:
+    # write_name before the preallocated buffer, returns the compressed name instead
+    wire, name_suffixes = name_encoding(name)
+    for suffix, position in name_suffixes:
+        pointer = suffixes.get(suffix)
+        if pointer is not None:
+            return wire[:position] + pointer
+        if offset + position <= MAX_POINTER:
+            suffixes[suffix] = (0xC000 | (offset + position)).to_bytes(2, "big")
+    return wire
+
+
+def concatenated_to_bytes(response: DNSResponse, compress: bool) -> bytes:
+    # DNSResponse.to_bytes before the preallocated buffer, one += per question and record
+    message = response.header.to_bytes()
+    suffixes = {}
+    for q in response.question:
+        if compress:
+            # only the whole question name is a pointer target
+            name_suffixes = name_encoding(q.qname)[1]
+            if name_suffixes:
+                pointer = (0xC000 | len(message)).to_bytes(2, "big")
+                suffixes.setdefault(name_suffixes[0][0], pointer)
+        message += q.to_bytes()
+    for section in (response.answer, response.authority, response.additional):
+        for record in section:
+            if compress:
+                message += compress_name(record.name, len(message), suffixes)
+            else:
+                message += encode_name(record.name)
+            data = record.data.encode("ascii")
+            message += (
+                record.type_.to_bytes(2, byteorder="big")
+                + struct.pack("!H", len(data))
+                + data
+            )
+    return message
+
+
+def uncached_encode_name(name: str) -> bytes:
+    # the name encoder before name encodings were cached, split and joined every call
+    if name == ".":
+        return b"\x00"
+    parts = name.split(".")
+    if parts[-1] == "":
+        parts = parts[:-1]
+    return (
+        b"".join(
+            (len(part).to_bytes(1, "big") + part.encode("ascii")) for part in parts
+        )
+        + b"\x00"
+    )
+
+
+def uncached_to_bytes(response: DNSResponse) -> bytes:
+    # the original path: += concatenation, names re-encoded every time, no compression
+    message = response.header.to_bytes()
+    for q in response.question:
+        message += uncached_encode_name(q.qname) + q.qtype.to_bytes(2, byteorder="big")
+    for section in (response.answer, response.authority, response.additional):
+        for record in section:
+            data = record.data.encode("ascii")
+            message += (
+                uncached_encode_name(record.name)
+                + record.type_.to_bytes(2, byteorder="big")
+                + struct.pack("!H", len(data))
+                + data
+            )
+    return message
+
+
+def bench_serialize(iterations: int = 2000):
+    """
+    Encoding responses with large answer sets, += concatenation vs one preallocated buffer.
+    """
+    for num_records in (10, 100, 500):
+        qname = "www.example.com."
+        answers = [
+            DNSRecord(name=qname, type_=TYPE_A, data=f"10.0.{i // 256}.{i % 256}")
+            for i in range(num_records)
+        ]
+        # a referral's worth of delegations and glue under the same suffix
+        authority = [
+            DNSRecord(name="example.com.", type_=TYPE_NS, data=f"ns{i}.example.com.")
+            for i in range(num_records // 10)
+        ]
+        additional = [
+            DNSRecord(name=f"ns{i}.example.com.", type_=TYPE_A, data=f"192.0.2.{i}")
+            for i in range(num_records // 10)
+        ]
+        header = DNSHeader(
+            qid=1,
+            flags=FLAG_RESPONSE,
+            num_questions=1,
+            num_answers=len(answers),
+            num_authorities=len(authority),
+            num_additionals=len(additional),
+        )
+        response = DNSResponse(
+            header, [DNSQuestion(qname, TYPE_A)], answers, authority, additional
+        )
+        assert concatenated_to_bytes(response, compress=True) == response.to_bytes()
+
+        rounds = max(1, iterations * 10 // num_records)
+        print(
+            f"serialize: {num_records + 2 * (num_records // 10)} records, "
+            f"{len(uncached_to_bytes(response))} -> {len(response.to_bytes())} bytes compressed"
+        )
+        seconds = timeit.timeit(lambda: uncached_to_bytes(response), number=rounds)
+        report("+= concatenation, no compression", seconds, rounds)
+        seconds = timeit.timeit(
+            lambda: concatenated_to_bytes(response, compress=True), number=rounds
+        )
+        report("+= concatenation, compressed", seconds, rounds)
+        seconds = timeit.timeit(response.to_bytes, number=rounds)
+        report("preallocated buffer, compressed", seconds, rounds)
+
+
+def bytesio_from_bytes(data: bytes) -> DNSResponse:
+    # DNSResponse.from_bytes before the memoryview decoder, a BytesIO read a byte at a time
+    reader = BytesIO(data)
+    header = DNSHeader.parse_header(reader)
+    questions = []
+    for _ in range(header.num_questions):
+        qname = DNSResponse.decode_name(reader)
+        qtype = struct.unpack("!H", reader.read(2))[0]
+        questions.append(DNSQuestion(qname, qtype))
+    answers = [DNSResponse.parse_record(reader) for _ in range(header.num_answers)]
+    authorities = [
+        DNSResponse.parse_record(reader) for _ in range(header.num_authorities)
+    ]
+    additionals = [
+        DNSResponse.parse_record(reader) for _ in range(header.num_additionals)
+    ]
+    return DNSResponse(header, questions, answers, authorities, additionals)
+
+
+def bench_decode(iterations: int = 2000):
+    """
+    Decoding compressed responses, BytesIO reads vs memoryview offsets.
+    """
+    for num_glue in (2, 13):
+        # a referral, like the ones a monitoring probe parses over and over
+        zone = "example.com."
+        authority = [
+            DNSRecord(name=zone, type_=TYPE_NS, data=f"ns{i}.{zone}")
+            for i in range(num_glue)
+        ]
+        additional = [
+            DNSRecord(name=f"ns{i}.{zone}", type_=TYPE_A, data=f"192.0.2.{i}")
+            for i in range(num_glue)
+        ]
+        header = DNSHeader(
+            qid=1,
+            flags=FLAG_RESPONSE,
+            num_questions=1,
+            num_authorities=len(authority),
+            num_additionals=len(additional),
+        )
+        data = DNSResponse(
+            header,
+            [DNSQuestion(f"www.probe.{zone}", TYPE_A)],
+            [],
+            authority,
+            additional,
+        ).to_bytes()
+        assert DNSResponse.from_bytes(data) == bytesio_from_bytes(data)
+
+        print(f"decode: referral with {2 * num_glue} records, {len(data)} bytes")
+        seconds = timeit.timeit(lambda: bytesio_from_bytes(data), number=iterations)
+        report("BytesIO, byte at a time", seconds, iterations)
+        seconds = timeit.timeit(lambda: DNSResponse.from_bytes(data), number=iterations)
+        report("memoryview, unpack_from", seconds, iterations)
+
+
+BENCHMARKS = {
+    "nameservers": bench_nameservers,
+    "cache": bench_cache,
+    "serialize": bench_serialize,
+    "decode": bench_decode,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.exit(
+                f"Error: unknown benchmark {name}, choose from {', '.join(BENCHMARKS)}"
+            )
+        BENCHMARKS[name]()
+        print()
@@ -2,6 +2,7 @@
 
 from dataclasses import dataclass
 import dataclasses
+import functools
 from io import BytesIO
 import struct
 from typing import List
@@ -17,6 +18,22 @@ FLAG_RESPONSE = 1
 
 BUFFERSIZE = 4096
 
+HEADER_SIZE = 12
+MAX_LABEL_LENGTH = 63  # RFC 1035 section 2.3.4
+MAX_NAME_LENGTH = 255
+MAX_POINTER = 0x3FFF  # compression pointers have 14 bits of offset
+MAX_POINTER_JUMPS = 32  # pointers followed for one name, more means a loop
+
+HEADER_STRUCT = struct.Struct("!HHHHHH")
+QTYPE_STRUCT = struct.Struct("!H")
+# type, data length and data, one per data length seen
+RECORD_STRUCTS = {}
+RECORD_HEADER_STRUCT = struct.Struct("!HH")  # type and data length
+
+# encoded names kept each way, a few thousand names make up most traffic. The
+# caches are functools.lru_cache, bounded, least recently used out and thread-safe.
+NAME_CACHE_SIZE = 4096
+
 
 def get_qtype(qtype):
     if qtype == TYPE_A:
@@ -29,6 +46,100 @@ def get_qtype(qtype):
         return "INVALID"
 
 
+@functools.lru_cache(maxsize=NAME_CACHE_SIZE)
+def name_encoding(name: str) -> tuple:
+    """
+    Encode a domain name as length-prefixed labels ending in a zero byte, and note
+    where each of its suffixes starts, for compression.
+
+    :return: The wire encoding, and a tuple of (lowercased suffix, offset into the
+        encoding) from the whole name down to its last label.
+    """
+    if name == ".":
+        # Special case for the root domain
+        return b"\x00", ()
+
+    parts = name.split(".")
+    # Remove the last empty part if name ends with a dot
+    if parts[-1] == "":
+        parts = parts[:-1]
+
+    wire = b""
+    suffixes = []
+    for i, part in enumerate(parts):
+        suffixes.append((".".join(parts[i:]).lower(), len(wire)))
+        label = part.encode("ascii")
+        wire += len(label).to_bytes(1, "big") + label
+    return wire + b"\x00", tuple(suffixes)
+
+
+def encode_name(name: str) -> bytes:
+    """
+    Encode a domain name as length-prefixed labels ending in a zero byte.
+    """
+    return name_encoding(name)[0]
+
+
+@functools.lru_cache(maxsize=NAME_CACHE_SIZE)
+def decode_labels(labels: bytes) -> str:
+    """
+    Length-prefixed labels, without the zero byte or pointer that ends them, as
+    text: b"\\x03www\\x07example" -> "www.example."
+
+    :raises UnicodeDecodeError: If a label isn't ASCII.
+    """
+    if not labels:
+        return ""
+    text = bytearray(labels)
+    offset = 0
+    while offset < len(labels):
+        text[offset] = 0x2E  # "."
+        offset += 1 + labels[offset]
+    return text[1:].decode("ascii") + "."
+
+
+def name_cache_stats() -> dict:
+    """
+    Hits and misses of the encoded-name caches, both ways.
+    """
+    stats = {}
+    for direction, cached in (("encode", name_encoding), ("decode", decode_labels)):
+        info = cached.cache_info()
+        lookups = info.hits + info.misses
+        stats[direction] = {
+            "entries": info.currsize,
+            "hits": info.hits,
+            "misses": info.misses,
+            "hit_rate": info.hits / lookups if lookups else 0.0,
+        }
+    return stats
+
+
+def write_name(buffer: bytearray, offset: int, name: str, suffixes: dict) -> int:
+    """
+    Write a domain name into buffer at offset, ending in a pointer to an earlier copy
+    of its longest known suffix (RFC 1035 section 4.1.4).
+
+    :param suffixes: Lowercased suffix -> the 2-byte pointer to an earlier copy, the
+        suffixes written by this call are added to it.
+    :return: The offset just past the name.
+    """
+    wire, name_suffixes = name_encoding(name)
+    for suffix, position in name_suffixes:
+        pointer = suffixes.get(suffix)
+        if pointer is not None:
+            if position:
+                buffer[offset : offset + position] = wire[:position]
+                offset += position
+            buffer[offset : offset + 2] = pointer
+            return offset + 2
+        if offset + position <= MAX_POINTER:
+            suffixes[suffix] = (0xC000 | (offset + position)).to_bytes(2, "big")
+    end = offset + len(wire)
+    buffer[offset:end] = wire
+    return end
+
+
 # with reference to https://implement-dns.wizardzines.com/book/part_1
 @dataclass
 class DNSHeader:
@@ -63,51 +174,126 @@ class DNSQuestion:
     qtype: int  #  type of the query
 
     def to_bytes(self) -> bytes:
-        if self.qname == ".":
-            # Special case for the root domain
-            qname_bytes = b"\x00"
-        else:
-            qname_parts = self.qname.split(".")
-            # Remove the last empty part if qname ends with a dot
-            if qname_parts[-1] == "":
-                qname_parts = qname_parts[:-1]
-
-            qname_bytes = (
-                b"".join(
-                    (len(part).to_bytes(1, "big") + part.encode("ascii"))
-                    for part in qname_parts
-                )
-                + b"\x00"
-            )
-        return qname_bytes + self.qtype.to_bytes(2, byteorder="big")
+        return encode_name(self.qname) + self.qtype.to_bytes(2, byteorder="big")
+
+    def key(self) -> str:
+        """
+        The name used for lookups, DNS names are case-insensitive
+        """
+        return self.qname.lower()
 
 
 @dataclass
-class DNSRecord:
-    name: str  # domain name
-    type_: int  #  type of the resource record
-    data: str  # type-dependent data which describes the resource
+class ReceivedQuestion(DNSQuestion):
+    lookup_key: str = ""  # lowercased qname
+    wire: bytes = b""  # qname and qtype exactly as they arrived
 
     def to_bytes(self) -> bytes:
+        # echo the question back byte for byte
+        return self.wire
 
-        if self.name == ".":
-            # Special case for the root domain
-            name_bytes = b"\x00"
-        else:
-            name_parts = self.name.split(".")
+    def key(self) -> str:
+        return self.lookup_key
 
-            # Remove the last empty part if qname ends with a dot
-            if name_parts[-1] == "":
-                name_parts = name_parts[:-1]
 
-            name_bytes = (
-                b"".join(
-                    (len(part).to_bytes(1, "big") + part.encode("ascii"))
-                    for part in name_parts
-                )
-                + b"\0"
-            )
+def parse_query(data) -> tuple:
+    """
+    Parse the header and questions of a query straight out of the datagram.
+
+    :param data: The received datagram (bytes, bytearray or memoryview).
+    :return: The DNSHeader and a list of ReceivedQuestion.
+    :raises ValueError: If the datagram is truncated or malformed.
+    """
+    view = memoryview(data)
+    end = len(view)
+    if end < HEADER_SIZE:
+        raise ValueError(f"Query too short: {end} bytes")
 
+    header = DNSHeader(*struct.unpack_from("!HHHHHH", view, 0))
+
+    questions = []
+    offset = HEADER_SIZE
+    for _ in range(header.num_questions):
+        start = offset
+        while True:
+            if offset >= end:
+                raise ValueError("Query truncated inside a name")
+            length = view[offset]
+            if length == 0:
+                offset += 1
+                break
+            if length > MAX_LABEL_LENGTH:
+                # also catches compression pointers, a question never needs one
+                raise ValueError(f"Bad label length {length} at offset {offset}")
+            offset += 1 + length
+            if offset - start > MAX_NAME_LENGTH:
+                raise ValueError("Name longer than 255 bytes")
+
+        labels_end = offset - start - 1  # the labels stop at the zero byte
+        if offset + 2 > end:
+            raise ValueError("Query truncated before qtype")
+        (qtype,) = struct.unpack_from("!H", view, offset)
+        offset += 2
+
+        wire = view[start:offset].tobytes()
+        try:
+            qname = decode_labels(wire[:labels_end]) or "."  # "." is the root domain
+        except UnicodeDecodeError:
+            raise ValueError("Name is not ASCII") from None
+        questions.append(ReceivedQuestion(qname, qtype, qname.lower(), wire))
+
+    return header, questions
+
+
+def read_name(view: memoryview, offset: int, names: dict, jumps: int = 0) -> tuple:
+    """
+    Decode the name at offset in a message, following compression pointers.
+
+    :param view: The whole message.
+    :param names: Offset -> name decoded there, for this message only. Every name
+        decoded is added, so later pointers to it are answered without decoding.
+    :param jumps: Pointers already followed to get here.
+    :return: The name, and the offset just past where it is stored.
+    :raises ValueError: If the name runs past the message or its pointers loop.
+    """
+    start = offset
+    end = len(view)
+    while True:
+        if offset >= end:
+            raise ValueError(f"Name at offset {start} runs past the end of the message")
+        length = view[offset]
+        if length == 0:
+            name = decode_labels(view[start:offset].tobytes()) or "."
+            names[start] = name
+            return name, offset + 1
+        if length & 0b11000000 == 0b11000000:
+            if offset + 1 >= end:
+                raise ValueError(f"Pointer at offset {offset} is cut off")
+            target = (length & 0b00111111) << 8 | view[offset + 1]
+            suffix = names.get(target)
+            if suffix is None:
+                if jumps == MAX_POINTER_JUMPS:
+                    raise ValueError(
+                        f"More than {MAX_POINTER_JUMPS} pointers in the name at offset {start}"
+                    )
+                suffix = read_name(view, target, names, jumps + 1)[0]
+            if offset == start:
+                return suffix, offset + 2  # nothing but a pointer, the usual owner name
+            prefix = decode_labels(view[start:offset].tobytes())
+            name = prefix + suffix if suffix != "." else prefix or "."
+            names[start] = name
+            return name, offset + 2
+        offset += 1 + length
+
+
+@dataclass(frozen=True, slots=True)
+class DNSRecord:
+    name: str  # domain name
+    type_: int  #  type of the resource record
+    data: str  # type-dependent data which describes the resource
+
+    def to_bytes(self) -> bytes:
+        name_bytes = encode_name(self.name)
         data_bytes = self.data.encode("ascii")
         type_bytes = self.type_.to_bytes(2, byteorder="big")
         return name_bytes + type_bytes + struct.pack("!H", len(self.data)) + data_bytes
@@ -122,44 +308,103 @@ class DNSResponse:
     additional: List[DNSRecord]
 
     def to_bytes(self) -> bytes:
-        message = self.header.to_bytes()
+        records = [*self.answer, *self.authority, *self.additional]
+
+        # an encoded name is at most 2 bytes longer than its text, and the message
+        # is sized for no compression at all, then cut to what was written
+        size = HEADER_SIZE + sum(len(q.qname) + 4 for q in self.question)
+        for record in records:
+            size += len(record.name) + 6 + len(record.data)
+        buffer = bytearray(size)
+
+        header = self.header
+        HEADER_STRUCT.pack_into(
+            buffer,
+            0,
+            header.qid,
+            header.flags,
+            header.num_questions,
+            header.num_answers,
+            header.num_authorities,
+            header.num_additionals,
+        )
+        offset = HEADER_SIZE
+        # owner names point back at earlier copies of their suffixes, record
+        # data is text and is never compressed
+        suffixes = {}
         for q in self.question:
-            message += q.to_bytes()
-        for a in self.answer:
-            message += a.to_bytes()
-        for auth in self.authority:
-            message += auth.to_bytes()
-        for add in self.additional:
-            message += add.to_bytes()
-        return message
+            # only the whole question name may be pointed at: a cached response is
+            # sent with the question in the client's casing, and a pointer into
+            # part of it would change the case of unrelated owner names
+            start = offset
+            offset = write_name(buffer, offset, q.qname, {})
+            name_suffixes = name_encoding(q.qname)[1]
+            if name_suffixes and start <= MAX_POINTER:
+                suffixes.setdefault(
+                    name_suffixes[0][0], (0xC000 | start).to_bytes(2, "big")
+                )
+            QTYPE_STRUCT.pack_into(buffer, offset, q.qtype)
+            offset += 2
+        for record in records:
+            offset = write_name(buffer, offset, record.name, suffixes)
+            data = record.data.encode("ascii")
+            record_struct = RECORD_STRUCTS.get(len(data))
+            if record_struct is None:
+                record_struct = RECORD_STRUCTS[len(data)] = struct.Struct(
+                    f"!HH{len(data)}s"
+                )
+            record_struct.pack_into(buffer, offset, record.type_, len(data), data)
+            offset += record_struct.size
+        return bytes(memoryview(buffer)[:offset])
 
     @classmethod
     def from_bytes(cls, data: bytes):
-        # print('data', data)
-        reader = BytesIO(data)
-        if len(data) < 12:
+        view = memoryview(data)
+        end = len(view)
+        if end < HEADER_SIZE:
             raise ValueError(
                 f"Data too short: expected at least 12 bytes, got {len(data)} bytes"
             )
 
-        header = DNSHeader.parse_header(reader)
+        header = DNSHeader(*HEADER_STRUCT.unpack_from(view, 0))
 
+        names = {}  # offset -> name, pointers mostly land on names already decoded
+        offset = HEADER_SIZE
         questions = []
         for _ in range(header.num_questions):
-            qname = cls.decode_name(reader)
-            qtype = struct.unpack("!H", reader.read(2))[0]
+            qname, offset = read_name(view, offset, names)
+            if offset + 2 > end:
+                raise ValueError("Message truncated inside a question")
+            (qtype,) = QTYPE_STRUCT.unpack_from(view, offset)
+            offset += 2
             questions.append(DNSQuestion(qname, qtype))
 
-        answers = [cls.parse_record(reader) for _ in range(header.num_answers)]
-        authorities = [cls.parse_record(reader) for _ in range(header.num_authorities)]
-        additionals = [cls.parse_record(reader) for _ in range(header.num_additionals)]
-
-        return cls(header, questions, answers, authorities, additionals)
+        sections = []
+        for count in (
+            header.num_answers,
+            header.num_authorities,
+            header.num_additionals,
+        ):
+            records = []
+            for _ in range(count):
+                name, offset = read_name(view, offset, names)
+                if offset + 4 > end:
+                    raise ValueError("Message truncated inside a record")
+                type_, data_len = RECORD_HEADER_STRUCT.unpack_from(view, offset)
+                offset += 4
+                if offset + data_len > end:
+                    raise ValueError("Message truncated inside record data")
+                record_data = str(view[offset : offset + data_len], "ascii")
+                offset += data_len
+                records.append(DNSRecord(name, type_, record_data))
+            sections.append(records)
+
+        return cls(header, questions, *sections)
 
     # with reference to https://implement-dns.wizardzines.com/book/part_2
     @classmethod
     def decode_name(cls, reader):
-        parts = []
+        labels = b""  # the name's labels as they are on the wire, for decode_labels
         while True:
             length_bytes = reader.read(1)
             if not length_bytes:
@@ -173,17 +418,16 @@ class DNSResponse:
                 )[0]
                 saved_position = reader.tell()
                 reader.seek(pointer)
-                parts.append(cls.decode_name(reader))
+                suffix = cls.decode_name(reader)
                 reader.seek(saved_position)
+                if suffix != ".":
+                    return decode_labels(labels) + suffix
                 break
             else:
-                parts.append(reader.read(length).decode("ascii"))
-
-        # Check if parts is empty, indicating a root domain
-        if not parts:
-            return "."
+                labels += length_bytes + reader.read(length)
 
-        return ".".join(parts) + "."
+        # no labels at all is the root domain
+        return decode_labels(labels) or "."
 
     @staticmethod
     def parse_record(reader: BytesIO) -> DNSRecord:
@@ -21,6 +21,16 @@ import threading
 import sys
 import random
 import socket  # Core lib, to send packet via UDP socket
+import argparse
+import asyncio
+import collections
+import dataclasses
+import heapq
+import json
+import os
+import select
+import tempfile
+import time
 from threading import (
     Thread,
 )  # threading will make the timer easily implemented
@@ -29,9 +39,11 @@ import struct
 from classes import (
     DNSHeader,
     DNSQuestion,
+    DNSRecord,
     DNSResponse,
     BUFFERSIZE,
     FLAG_QUERY,
+    HEADER_SIZE,
     TYPE_A,
     TYPE_CNAME,
     TYPE_NS,
@@ -39,6 +51,533 @@ from classes import (
     get_qtype,
 )
 
+QTYPES = {"A": TYPE_A, "CNAME": TYPE_CNAME, "NS": TYPE_NS}
+
+DEFAULT_WINDOW = 128  # queries a batch keeps outstanding at once
+DEFAULT_RETRIES = 2  # resends before a batch query counts as timed out
+DEFAULT_SOCKETS = 4  # UDP sockets an AsyncClient spreads its queries over
+MAX_QID = 2**16 - 1
+
+# retransmission timeouts, in seconds (RFC 6298, with a lower floor than TCP's)
+INITIAL_RTO = 1.0
+MIN_RTO = 0.2
+MAX_RTO = 60.0
+LISTEN_POLL = 0.1  # how often the listener checks whether it should stop
+
+# answer cache, responses carry no TTLs so every entry lives a fixed time
+DEFAULT_CACHE_SIZE = 4096
+DEFAULT_CACHE_TTL = 300.0
+CACHE_FILE_VERSION = 1
+
+# iterative resolution, how far a lookup may wander before it gives up
+MAX_REFERRALS = 16  # delegations followed for one name
+MAX_RESTARTS = 8  # CNAME targets looked up again from the top
+DEFAULT_DELEGATION_TTL = 300.0
+
+
+def qtype_code(qtype: str) -> int:
+    return QTYPES.get(qtype, TYPE_INVALID)
+
+
+def print_response(dns_response: DNSResponse) -> None:
+    """
+    Print a response in the client's output format.
+    """
+    header = dns_response.header
+
+    print(f"QID: {header.qid}")
+
+    print("\nQUESTION SECTION:")
+    for question in dns_response.question:
+        print(f"{question.qname:20}{get_qtype(question.qtype):5}")
+
+    for title, records in (
+        ("ANSWER SECTION", dns_response.answer),
+        ("AUTHORITY SECTION", dns_response.authority),
+        ("ADDITIONAL SECTION", dns_response.additional),
+    ):
+        if records:
+            print(f"\n{title}:")
+            for record in records:
+                print(f"{record.name:<20}{get_qtype(record.type_):<7}{record.data}")
+
+
+def read_questions(lines):
+    """
+    (qname, qtype) pairs from lines of "qname qtype", blank lines and # comments skipped.
+    """
+    for line in lines:
+        fields = line.split("#", 1)[0].split()
+        if len(fields) == 2:
+            yield fields[0], fields[1]
+        elif fields:
+            print(f"Skipping malformed line: {line.strip()}", file=sys.stderr)
+
+
+class RTTEstimator:
+    def __init__(
+        self,
+        initial_rto: float = INITIAL_RTO,
+        min_rto: float = MIN_RTO,
+        max_rto: float = MAX_RTO,
+    ) -> None:
+        """
+        A retransmission timeout from smoothed round-trip times, computed the way
+        TCP does it (RFC 6298): SRTT and RTTVAR, with exponential backoff on loss.
+        """
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+
+    def sample(self, rtt: float) -> None:
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto), self.max_rto)
+
+    def backoff(self) -> None:
+        self.rto = min(self.rto * 2, self.max_rto)
+
+
+class AnswerCache:
+    def __init__(
+        self, max_entries: int = DEFAULT_CACHE_SIZE, ttl: float = DEFAULT_CACHE_TTL
+    ) -> None:
+        """
+        Responses by (qname, qtype), least recently used evicted first.
+
+        The server's records have no TTLs, so an entry expires ttl seconds after it
+        was stored. Safe to share between the listener thread and the caller.
+
+        :param max_entries: The most responses kept, the least recently used goes first.
+        :param ttl: Seconds a response is served from the cache.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # (qname, qtype) -> (expires, response), least recently used first
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(qname: str, qtype) -> tuple:
+        if isinstance(qtype, str):
+            qtype = qtype_code(qtype)
+        return qname.lower(), qtype
+
+    def get(self, qname: str, qtype) -> DNSResponse | None:
+        """
+        The cached response to this question, or None on a miss or once it expired.
+
+        The question section is the one asked, names compare case-insensitively.
+        """
+        key = self.key(qname, qtype)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        response = entry[1]
+        return DNSResponse(
+            dataclasses.replace(response.header),
+            [DNSQuestion(qname=qname, qtype=key[1])],
+            response.answer,
+            response.authority,
+            response.additional,
+        )
+
+    def put(
+        self, qname: str, qtype, response: DNSResponse, expires: float | None = None
+    ) -> None:
+        key = self.key(qname, qtype)
+        if expires is None:
+            expires = time.time() + self.ttl
+        with self.lock:
+            self.entries[key] = (expires, response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class PersistentAnswerCache(AnswerCache):
+    def __init__(
+        self,
+        filename: str,
+        max_entries: int = DEFAULT_CACHE_SIZE,
+        ttl: float = DEFAULT_CACHE_TTL,
+    ) -> None:
+        """
+        An AnswerCache kept in a small JSON file between runs, load() it before use
+        and save() it after.
+
+        :param filename: The cache file, it is created by the first save().
+        """
+        super().__init__(max_entries, ttl)
+        self.filename = filename
+
+    def load(self) -> None:
+        """
+        Read the unexpired entries from the file, a missing or unreadable file
+        leaves the cache empty.
+        """
+        now = time.time()
+        loaded = []
+        try:
+            with open(self.filename) as f:
+                stored = json.load(f)
+            if stored.get("version") != CACHE_FILE_VERSION:
+                raise ValueError(f"unknown cache version {stored.get('version')}")
+            for entry in stored["entries"]:
+                qname, qtype, expires, header, answer, authority, additional = entry
+                if not isinstance(qname, str) or not isinstance(qtype, int):
+                    raise ValueError(f"malformed entry {entry}")
+                if expires <= now:
+                    continue
+                response = DNSResponse(
+                    DNSHeader(*header),
+                    [DNSQuestion(qname=qname, qtype=qtype)],
+                    [DNSRecord(*record) for record in answer],
+                    [DNSRecord(*record) for record in authority],
+                    [DNSRecord(*record) for record in additional],
+                )
+                loaded.append((qname, qtype, response, expires))
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, AttributeError, TypeError) as e:
+            print(f"Ignoring cache file {self.filename}: {e}", file=sys.stderr)
+            return
+
+        # stored oldest first, so the last one put is the most recently used
+        for qname, qtype, response, expires in loaded:
+            self.put(qname, qtype, response, expires)
+
+    def save(self) -> None:
+        """
+        Write the unexpired entries back, replacing the file in one step so a
+        concurrent run never reads half of it.
+        """
+        now = time.time()
+        with self.lock:
+            entries = [
+                [
+                    qname,
+                    qtype,
+                    expires,
+                    dataclasses.astuple(response.header),
+                    [dataclasses.astuple(record) for record in response.answer],
+                    [dataclasses.astuple(record) for record in response.authority],
+                    [dataclasses.astuple(record) for record in response.additional],
+                ]
+                for (qname, qtype), (expires, response) in self.entries.items()
+                if expires > now
+            ]
+        # a temporary file of its own, concurrent saves each replace the whole file
+        fd, temporary = tempfile.mkstemp(
+            prefix=os.path.basename(self.filename) + ".",
+            suffix=".tmp",
+            dir=os.path.dirname(self.filename) or ".",
+        )
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"version": CACHE_FILE_VERSION, "entries": entries}, f)
+            os.replace(temporary, self.filename)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+
+def in_zone(name: str, zone: str) -> bool:
+    """
+    Whether name is zone itself or below it, both fully qualified.
+    """
+    name, zone = name.lower(), zone.lower()
+    return zone == "." or name == zone or name.endswith("." + zone)
+
+
+@dataclasses.dataclass
+class Delegation:
+    zone: str  # lowercased, e.g. "example.com."
+    ports: list  # local ports of the servers for the zone, in referral order
+    glue: list  # the A records that came with the referral
+    expires: float
+
+
+class DelegationCache:
+    def __init__(self, ttl: float = DEFAULT_DELEGATION_TTL) -> None:
+        """
+        Delegations learnt from referrals, so later lookups under a zone start at
+        its servers instead of the root. Like AnswerCache, entries live ttl seconds.
+        """
+        self.ttl = ttl
+        self.entries = {}  # zone -> Delegation
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, qname: str) -> Delegation | None:
+        """
+        The unexpired delegation closest to qname, or None if only the root is known.
+        """
+        name = qname.lower()
+        now = time.time()
+        with self.lock:
+            while name != ".":
+                entry = self.entries.get(name)
+                if entry is not None:
+                    if entry.expires > now:
+                        self.hits += 1
+                        return entry
+                    del self.entries[name]
+                # "www.example.com." -> "example.com." -> "com." -> "."
+                name = name.partition(".")[2] or "."
+            self.misses += 1
+        return None
+
+    def put(self, zone: str, ports: list, glue: list) -> Delegation:
+        delegation = Delegation(zone.lower(), ports, glue, time.time() + self.ttl)
+        with self.lock:
+            self.entries[delegation.zone] = delegation
+        return delegation
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+@dataclasses.dataclass
+class Resolution:
+    response: DNSResponse | None  # None if a server stopped answering
+    queries: int = 0  # round trips to servers, retransmissions not counted
+    referrals: int = 0  # delegations followed
+    restarts: int = 0  # CNAME targets looked up again
+    cached: int = 0  # lookups that started at a cached delegation
+    from_cache: bool = False  # answered by the AnswerCache without a query
+
+
+class IterativeResolver:
+    def __init__(
+        self,
+        root_port: int,
+        nameservers: dict,
+        timeout: float,
+        delegations: DelegationCache | None = None,
+        cache: AnswerCache | None = None,
+    ) -> None:
+        """
+        Resolve a name by following referrals from one local server to the next.
+
+        Every server instance listens on 127.0.0.1, so a referral is followed by
+        looking its nameservers up in nameservers: a nameserver's name, or the
+        address in its glue record, mapped to the port that instance listens on.
+
+        :param root_port: The server asked when no delegation is cached.
+        :param nameservers: Nameserver names or glue addresses -> local ports.
+        :param timeout: Seconds to wait for each server before trying the next.
+        :param delegations: Delegations learnt so far, shared between resolvers.
+        :param cache: Final answers to reuse, a hit is returned without any query.
+        """
+        self.root_port = int(root_port)
+        self.nameservers = {key.lower(): int(port) for key, port in nameservers.items()}
+        self.timeout = float(timeout)
+        self.delegations = delegations if delegations is not None else DelegationCache()
+        self.cache = cache
+        self.rtts = {}  # port -> RTTEstimator
+        self.client_socket = socket.socket(
+            family=socket.AF_INET, type=socket.SOCK_DGRAM
+        )
+
+    def resolve(self, qname: str, qtype) -> Resolution:
+        """
+        Follow referrals until a server answers, restarting at the closest known
+        delegation whenever the answer is a CNAME that leads out of its zone.
+
+        :param qname: The target domain name of the query.
+        :param qtype: The type of the query, 'A', 'CNAME', 'NS' or its numeric code.
+        :return: The answer as if one server had given it, the CNAME records from
+            every restart first, and how many round trips it took.
+        """
+        if isinstance(qtype, str):
+            qtype = qtype_code(qtype)
+        if self.cache is not None:
+            cached = self.cache.get(qname, qtype)
+            if cached is not None:
+                return Resolution(cached, from_cache=True)
+        result = Resolution(None)
+        chain = []  # answer records gathered across CNAME restarts
+        name = qname
+
+        while True:
+            delegation = self.delegations.get(name)
+            if delegation is not None:
+                result.cached += 1
+                zone, ports = delegation.zone, delegation.ports
+            else:
+                zone, ports = ".", [self.root_port]
+
+            for _ in range(MAX_REFERRALS):
+                dns_response = self.query_any(ports, name, qtype, result)
+                if dns_response is None:
+                    return result
+                referral = self.learn(dns_response)
+
+                if dns_response.answer:
+                    chain.extend(dns_response.answer)
+                    target = self.follow(name, dns_response.answer)
+                    if qtype == TYPE_CNAME or any(
+                        record.type_ == qtype and record.name.lower() == target.lower()
+                        for record in dns_response.answer
+                    ):
+                        break  # answered
+                    # the chain leaves this server's data, look its end up afresh
+                    name = target
+                    zone = None
+                    break
+
+                if (
+                    referral is None
+                    or not in_zone(name, referral.zone)
+                    or referral.zone == zone
+                    or not in_zone(referral.zone, zone)
+                ):
+                    break  # no closer servers, this is the final answer
+                zone, ports = referral.zone, referral.ports
+                result.referrals += 1
+
+            if zone is None and result.restarts < MAX_RESTARTS:
+                result.restarts += 1
+                continue
+            result.response = DNSResponse(
+                dataclasses.replace(dns_response.header, num_answers=len(chain)),
+                [DNSQuestion(qname=qname, qtype=qtype)],
+                chain,
+                dns_response.authority,
+                dns_response.additional,
+            )
+            if self.cache is not None:
+                self.cache.put(qname, qtype, result.response)
+            return result
+
+    @staticmethod
+    def follow(name: str, answer: list) -> str:
+        """
+        The name at the end of the CNAME chain starting at name.
+        """
+        cnames = {
+            record.name.lower(): record.data
+            for record in answer
+            if record.type_ == TYPE_CNAME
+        }
+        seen = set()
+        while name.lower() in cnames and name.lower() not in seen:
+            seen.add(name.lower())
+            name = cnames[name.lower()]
+        return name
+
+    def learn(self, dns_response: DNSResponse) -> Delegation | None:
+        """
+        Cache the delegation in a response's authority section, if any of its
+        nameservers is one we know the port of.
+        """
+        ns_records = [r for r in dns_response.authority if r.type_ == TYPE_NS]
+        if not ns_records:
+            return None
+        glue = [r for r in dns_response.additional if r.type_ == TYPE_A]
+        ports = []
+        for ns_record in ns_records:
+            port = self.nameservers.get(ns_record.data.lower())
+            if port is None:
+                for record in glue:
+                    if record.name.lower() == ns_record.data.lower():
+                        port = self.nameservers.get(record.data)
+                        if port is not None:
+                            break
+            if port is not None and port not in ports:
+                ports.append(port)
+        if not ports:
+            return None
+        return self.delegations.put(ns_records[0].name, ports, glue)
+
+    def query_any(
+        self, ports: list, qname: str, qtype: int, result: Resolution
+    ) -> DNSResponse | None:
+        for port in ports:
+            dns_response = self.query(port, DNSQuestion(qname=qname, qtype=qtype))
+            if dns_response is not None:
+                result.queries += 1
+                return dns_response
+        return None
+
+    def query(self, port: int, question: DNSQuestion) -> DNSResponse | None:
+        """
+        Ask one server, resending on its retransmission timeout until timeout runs out.
+        """
+        server_address = ("127.0.0.1", port)
+        rtt = self.rtts.setdefault(port, RTTEstimator())
+        question_bytes = question.to_bytes()
+        attempts = {}  # qid -> when that attempt was sent
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                return None
+            qid = random.randint(1, MAX_QID)
+            header = DNSHeader(qid=qid, flags=FLAG_QUERY, num_questions=1)
+            attempts[qid] = now
+            self.client_socket.sendto(
+                header.to_bytes() + question_bytes, server_address
+            )
+
+            resend_at = min(now + rtt.rto, deadline)
+            while (wait := resend_at - time.monotonic()) > 0:
+                readable, _, _ = select.select([self.client_socket], [], [], wait)
+                if not readable:
+                    break
+                try:
+                    data, address = self.client_socket.recvfrom(BUFFERSIZE)
+                except ConnectionRefusedError:
+                    continue  # ICMP from an earlier query, the timeout covers it
+                if address != server_address or len(data) < HEADER_SIZE:
+                    continue
+                (reply_qid,) = struct.unpack_from("!H", data)
+                question_end = HEADER_SIZE + len(question_bytes)
+                sent_at = attempts.get(reply_qid)
+                if sent_at is None or data[HEADER_SIZE:question_end] != question_bytes:
+                    continue  # a late reply to an earlier question
+                try:
+                    dns_response = DNSResponse.from_bytes(data)
+                except ValueError:
+                    continue
+                rtt.sample(time.monotonic() - sent_at)
+                return dns_response
+            rtt.backoff()
+
+    def close(self) -> None:
+        self.client_socket.close()
+
 
 class Client:
     def __init__(
@@ -47,6 +586,8 @@ class Client:
         qname: str,
         qtype: str,
         timeout: int,
+        rtt: RTTEstimator | None = None,
+        cache: AnswerCache | None = None,
     ) -> None:
         """
         Initialize the Client instance for querying DNS records via UDP.
@@ -56,12 +597,22 @@ class Client:
         :param qtype: The type of the query ('A', 'CNAME', 'NS').
         :param timeout: The duration (in seconds) the client should wait for a response before considering it a failure.
         :param client_port: The UDP port number to be used by the client for sending queries (default is CLIENT_PORT).
+        :param rtt: The round-trip estimate to time retransmissions with, pass the same
+            one to successive clients so it carries over.
+        :param cache: Answers to reuse, a hit is printed without querying the server.
         """
         self.server_port = int(server_port)
         self.server_address = ("127.0.0.1", self.server_port)
         self.qname = qname
         self.qtype = qtype
         self.timeout = int(timeout)
+        self.rtt = rtt if rtt is not None else RTTEstimator()
+        self.cache = cache
+
+        # Determine the query type based on the input
+        question = DNSQuestion(qname=self.qname, qtype=qtype_code(self.qtype))
+        self.question_bytes = question.to_bytes()
+        self.attempts = {}  # qid -> when that attempt was sent
 
         # init the UDP socket (ephemeral port)
         self.client_socket = socket.socket(
@@ -76,28 +627,19 @@ class Client:
 
     def create_and_send_query(self):
         """
-        Construct and send the DNS query to the server.
+        Construct and send the DNS query to the server, every attempt gets its own QID
+        so a reply tells which attempt it answers.
 
         """
         qid = random.randint(1, 2**16 - 1)
+        while qid in self.attempts:
+            qid = random.randint(1, 2**16 - 1)
         header = DNSHeader(qid=qid, flags=FLAG_QUERY, num_questions=1)
         header_bytes = header.to_bytes()
 
-        # Determine the query type based on the input
-        qtype = (
-            TYPE_A
-            if self.qtype == "A"
-            else (
-                TYPE_CNAME
-                if self.qtype == "CNAME"
-                else TYPE_NS if self.qtype == "NS" else TYPE_INVALID
-            )
-        )
-        question = DNSQuestion(qname=self.qname, qtype=qtype)
-        question_bytes = question.to_bytes()
-
-        content = header_bytes + question_bytes
+        content = header_bytes + self.question_bytes
 
+        self.attempts[qid] = time.monotonic()
         self.client_socket.sendto(content, self.server_address)
 
     def listen(self):
@@ -105,14 +647,10 @@ class Client:
 
         while self._is_active:
             try:
-                self.client_socket.settimeout(self.timeout)
-                incoming_message, _ = self.client_socket.recvfrom(BUFFERSIZE)
-                self.handle_response(incoming_message)
-                self.response_received_event.set()
-                self._is_active = False  # Stop listening after receiving the response
+                self.client_socket.settimeout(LISTEN_POLL)
+                incoming_message, address = self.client_socket.recvfrom(BUFFERSIZE)
             except socket.timeout:
-                print("Request timed out")
-                self._is_active = False
+                continue
             except OSError as e:
                 if not self._is_active:
                     # Socket was closed as expected
@@ -120,6 +658,28 @@ class Client:
                 else:
                     raise e
 
+            sent_at = self.match(incoming_message, address)
+            if sent_at is None:
+                continue  # not an answer to any of our attempts
+            # no retransmission ambiguity, the QID says which attempt this answers
+            self.rtt.sample(time.monotonic() - sent_at)
+            self.handle_response(incoming_message)
+            self._is_active = False  # Stop listening after receiving the response
+            self.response_received_event.set()
+
+    def match(self, message: bytes, address) -> float | None:
+        """
+        When the attempt this message answers was sent, or None if it answers none.
+        """
+        if address != self.server_address or len(message) < HEADER_SIZE:
+            return None
+        (qid,) = struct.unpack_from("!H", message)
+        question_end = HEADER_SIZE + len(self.question_bytes)
+        # the server echoes the question exactly as it was sent
+        if message[HEADER_SIZE:question_end] != self.question_bytes:
+            return None
+        return self.attempts.get(qid)
+
     def handle_response(self, response):
         """
         Process the DNS response from the server.
@@ -127,34 +687,11 @@ class Client:
         :param response: The response packet from the server.
         """
         dns_response = DNSResponse.from_bytes(response)
-
-        header = dns_response.header
-        questions = dns_response.question
-        answers = dns_response.answer
-        authorities = dns_response.authority
-        additionals = dns_response.additional
+        if self.cache is not None:
+            self.cache.put(self.qname, self.qtype, dns_response)
 
         # Print the response in the required format
-        print(f"QID: {header.qid}")
-
-        print("\nQUESTION SECTION:")
-        for question in questions:
-            print(f"{question.qname:20}{get_qtype(question.qtype):5}")
-
-        if answers:
-            print("\nANSWER SECTION:")
-            for answer in answers:
-                self.print_record(answer)
-
-        if authorities:
-            print("\nAUTHORITY SECTION:")
-            for authority in authorities:
-                self.print_record(authority)
-
-        if additionals:
-            print("\nADDITIONAL SECTION:")
-            for additional in additionals:
-                self.print_record(additional)
+        print_response(dns_response)
 
         return dns_response
 
@@ -189,9 +726,29 @@ class Client:
         """
         This function contain the main logic of the receiver
         """
-        self.create_and_send_query()
+        cached = None
+        if self.cache is not None:
+            cached = self.cache.get(self.qname, self.qtype)
+        if cached is not None:
+            print_response(cached)
+            self._is_active = False
+            self.client_socket.close()
+            print("Socket closed.")
+            self.listen_thread.join()
+            return
 
-        self.response_received_event.wait(self.timeout+2) # some more time to listen for response/timeouts
+        deadline = time.monotonic() + self.timeout
+        while True:
+            self.create_and_send_query()
+            remaining = deadline - time.monotonic()
+            wait = max(0.0, min(self.rtt.rto, remaining))
+            # returns as soon as the listener sees a matching reply
+            if self.response_received_event.wait(wait):
+                break
+            if time.monotonic() >= deadline:
+                print("Request timed out")
+                break
+            self.rtt.backoff()
         self._is_active = False  # close the sub-thread
 
         self.client_socket.close()
@@ -199,15 +756,444 @@ class Client:
         self.listen_thread.join()
 
 
-if __name__ == "__main__":
-    if len(sys.argv) != 5:
+class BatchClient:
+    def __init__(
+        self,
+        server_port: int,
+        timeout: float,
+        window: int = DEFAULT_WINDOW,
+        retries: int = DEFAULT_RETRIES,
+        cache: AnswerCache | None = None,
+    ) -> None:
+        """
+        Resolve many names over one UDP socket, with a window of queries in flight.
+
+        :param server_port: The UDP port number on which the server is listening.
+        :param timeout: Seconds to wait for each attempt at a query.
+        :param window: The most queries outstanding at once.
+        :param retries: How many times a query is resent before it counts as timed out.
+        :param cache: Answers to reuse, cached questions are yielded without a query.
+        """
+        if window < 1:
+            raise ValueError("window must be at least 1")
+        if retries < 0:
+            raise ValueError("retries must not be negative")
+        self.server_address = ("127.0.0.1", int(server_port))
+        self.timeout = float(timeout)
+        self.window = min(window, 2**16 - 1)
+        self.retries = retries
+        self.cache = cache
+
+        self.client_socket = socket.socket(
+            family=socket.AF_INET, type=socket.SOCK_DGRAM
+        )
+        self.client_socket.setblocking(False)
+
+        self.pending = {}  # qid -> [qname, qtype, question bytes, attempts]
+        self.deadlines = []  # heap of (deadline, qid, attempt)
+        self.sent = 0
+        self.resent = 0
+        self.cached = 0
+
+    def resolve(self, questions):
+        """
+        Send every question and yield the results as they arrive, not in input order.
+
+        :param questions: An iterable of (qname, qtype) pairs, qtype as text ("A", "NS"...).
+        :return: An iterator of (qname, qtype, DNSResponse), the response is None
+            for a query that ran out of retries.
+        """
+        questions = iter(questions)
+        exhausted = False
+        while True:
+            while not exhausted and len(self.pending) < self.window:
+                try:
+                    qname, qtype = next(questions)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if self.cache is not None:
+                    cached = self.cache.get(qname, qtype)
+                    if cached is not None:
+                        self.cached += 1
+                        yield qname, qtype, cached
+                        continue
+                self.send(qname, qtype)
+
+            if not self.pending:
+                return
+
+            yield from self.expire()
+            if self.pending:
+                wait = max(0.0, self.deadlines[0][0] - time.monotonic())
+                readable, _, _ = select.select([self.client_socket], [], [], wait)
+                if readable:
+                    yield from self.receive()
+
+    def send(self, qname: str, qtype: str) -> None:
+        qid = random.randint(1, 2**16 - 1)
+        while qid in self.pending:
+            qid = random.randint(1, 2**16 - 1)
+        question = DNSQuestion(qname=qname, qtype=qtype_code(qtype))
+        self.pending[qid] = [qname, qtype, question.to_bytes(), 0]
+        self.transmit(qid)
+
+    def transmit(self, qid: int) -> None:
+        entry = self.pending[qid]
+        entry[3] += 1
+        header = DNSHeader(qid=qid, flags=FLAG_QUERY, num_questions=1)
+        try:
+            self.client_socket.sendto(header.to_bytes() + entry[2], self.server_address)
+        except BlockingIOError:
+            pass  # the send buffer is full, the retry timer covers it
+        self.sent += 1
+        heapq.heappush(self.deadlines, (time.monotonic() + self.timeout, qid, entry[3]))
+
+    def expire(self):
+        now = time.monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, qid, attempt = heapq.heappop(self.deadlines)
+            entry = self.pending.get(qid)
+            if entry is None or entry[3] != attempt:
+                continue  # answered, or a newer attempt has its own deadline
+            if attempt <= self.retries:
+                self.resent += 1
+                self.transmit(qid)
+            else:
+                del self.pending[qid]
+                yield entry[0], entry[1], None
+
+    def receive(self):
+        # drain everything that has arrived, one select per burst
+        while True:
+            try:
+                data, address = self.client_socket.recvfrom(BUFFERSIZE)
+            except BlockingIOError:
+                return
+            if address != self.server_address or len(data) < HEADER_SIZE:
+                continue
+            (qid,) = struct.unpack_from("!H", data)
+            entry = self.pending.get(qid)
+            # the server echoes the question exactly as it was sent
+            if (
+                entry is None
+                or data[HEADER_SIZE : HEADER_SIZE + len(entry[2])] != entry[2]
+            ):
+                continue  # a late duplicate, or not the question we asked
+            try:
+                dns_response = DNSResponse.from_bytes(data)
+            except ValueError:
+                continue
+            del self.pending[qid]
+            if self.cache is not None:
+                self.cache.put(entry[0], entry[1], dns_response)
+            yield entry[0], entry[1], dns_response
+
+    def close(self) -> None:
+        self.client_socket.close()
+
+
+class DNSClientProtocol(asyncio.DatagramProtocol):
+    def __init__(self) -> None:
+        """
+        One socket of an AsyncClient and the queries waiting on it.
+        """
+        self.transport = None
+        self.pending = {}  # qid -> (question bytes, future)
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data, addr) -> None:
+        if len(data) < HEADER_SIZE:
+            return
+        waiting = self.pending.get(struct.unpack_from("!H", data)[0])
+        if waiting is None:
+            return  # late, the query already timed out
+        question_bytes, future = waiting
+        # the server echoes the question exactly as it was sent
+        if data[HEADER_SIZE : HEADER_SIZE + len(question_bytes)] != question_bytes:
+            return
+        try:
+            dns_response = DNSResponse.from_bytes(data)
+        except ValueError:
+            return
+        if not future.done():
+            future.set_result(dns_response)
+
+    def error_received(self, exc) -> None:
+        # e.g. ICMP port unreachable when no server is listening, let the timeouts handle it
+        pass
+
+    def connection_lost(self, exc) -> None:
+        for _, future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Client closed"))
+
+
+class AsyncClient:
+    def __init__(
+        self,
+        server_port: int,
+        num_sockets: int = DEFAULT_SOCKETS,
+        max_in_flight: int = DEFAULT_WINDOW,
+        cache: AnswerCache | None = None,
+    ) -> None:
+        """
+        Resolve names from asyncio code, many queries at once over a few UDP sockets.
+
+            async with AsyncClient(server_port) as client:
+                response = await client.resolve("example.com.", "A", timeout=5)
+
+        :param server_port: The UDP port number on which the server is listening.
+        :param num_sockets: How many sockets the queries are spread over, each one
+            holds at most 65535 outstanding queries.
+        :param max_in_flight: The most queries sent and not yet answered, others wait
+            their turn so a burst doesn't overflow the server's socket buffer.
+        :param cache: Answers to reuse, a cached question is answered without a query.
+        """
+        self.server_address = ("127.0.0.1", int(server_port))
+        self.num_sockets = num_sockets
+        self.max_in_flight = min(max_in_flight, num_sockets * MAX_QID)
+        self.sockets = []
+        self.cache = cache
+        self.slots = None  # asyncio.Semaphore, made in start() inside the running loop
+
+    async def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        for _ in range(self.num_sockets):
+            _, protocol = await loop.create_datagram_endpoint(
+                DNSClientProtocol, remote_addr=self.server_address
+            )
+            self.sockets.append(protocol)
+        self.slots = asyncio.Semaphore(self.max_in_flight)
+
+    async def __aenter__(self) -> "AsyncClient":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.close()
+
+    async def resolve(self, qname: str, qtype, timeout: float) -> DNSResponse:
+        """
+        Send one query and wait for its response.
+
+        :param qname: The target domain name of the query.
+        :param qtype: The type of the query, 'A', 'CNAME', 'NS' or its numeric code.
+        :param timeout: Seconds to wait for the response once the query is sent,
+            time spent waiting for max_in_flight doesn't count.
+        :raises TimeoutError: If no matching response arrived in time.
+        """
+        if not self.sockets:
+            raise RuntimeError("AsyncClient.start() has not been awaited")
+        if isinstance(qtype, str):
+            qtype = qtype_code(qtype)
+        if self.cache is not None:
+            cached = self.cache.get(qname, qtype)
+            if cached is not None:
+                return cached
+        question_bytes = DNSQuestion(qname=qname, qtype=qtype).to_bytes()
+
+        async with self.slots:
+            # the least busy socket, its QIDs are unique among its own pending queries
+            protocol = min(self.sockets, key=lambda p: len(p.pending))
+            qid = random.randint(1, MAX_QID)
+            while qid in protocol.pending:
+                qid = random.randint(1, MAX_QID)
+
+            future = asyncio.get_running_loop().create_future()
+            protocol.pending[qid] = (question_bytes, future)
+            try:
+                header = DNSHeader(qid=qid, flags=FLAG_QUERY, num_questions=1)
+                protocol.transport.sendto(header.to_bytes() + question_bytes)
+                dns_response = await asyncio.wait_for(future, timeout)
+            finally:
+                del protocol.pending[qid]
+        if self.cache is not None:
+            self.cache.put(qname, qtype, dns_response)
+        return dns_response
+
+    def close(self) -> None:
+        for protocol in self.sockets:
+            protocol.transport.close()
+        self.sockets = []
+
+
+def open_cache(args) -> PersistentAnswerCache | None:
+    if not args.cache:
+        return None
+    cache = PersistentAnswerCache(args.cache, ttl=args.cache_ttl)
+    cache.load()
+    return cache
+
+
+def save_cache(cache: PersistentAnswerCache | None) -> None:
+    if cache is None:
+        return
+    try:
+        cache.save()
+    except OSError as e:
+        print(f"Could not save cache file {cache.filename}: {e}", file=sys.stderr)
+
+
+def run_batch(args, cache: PersistentAnswerCache | None = None) -> None:
+    if args.batch == "-":
+        lines = sys.stdin
+    else:
+        try:
+            lines = open(args.batch)
+        except OSError as e:
+            sys.exit(f"Error: {e}")
+
+    client = BatchClient(
+        args.server_port,
+        args.timeout,
+        window=args.window,
+        retries=args.retries,
+        cache=cache,
+    )
+    start = time.perf_counter()
+    answered = timed_out = 0
+    try:
+        for qname, qtype, dns_response in client.resolve(read_questions(lines)):
+            print(f"\n;; {qname} {qtype}")
+            if dns_response is None:
+                timed_out += 1
+                print("Request timed out")
+            else:
+                answered += 1
+                print_response(dns_response)
+    except KeyboardInterrupt:
+        print("\nExiting...")
+    finally:
+        client.close()
+        lines.close()
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"\n;; {answered} answered ({client.cached} from cache), {timed_out} timed out, "
+        f"{client.resent} resent in {elapsed:.3f}s",
+        file=sys.stderr,
+    )
+
+
+def parse_nameservers(pairs: list) -> dict:
+    nameservers = {}
+    for pair in pairs:
+        name, _, port = pair.rpartition("=")
+        if not name or not port.isdigit():
+            sys.exit(f"Error: --ns expects NAME=PORT, got {pair}")
+        nameservers[name] = int(port)
+    return nameservers
+
+
+def run_iterative(args, cache: PersistentAnswerCache | None = None) -> None:
+    resolver = IterativeResolver(
+        args.server_port, parse_nameservers(args.ns), args.timeout, cache=cache
+    )
+    if args.batch:
+        if args.batch == "-":
+            questions = list(read_questions(sys.stdin))
+        else:
+            try:
+                with open(args.batch) as lines:
+                    questions = list(read_questions(lines))
+            except OSError as e:
+                sys.exit(f"Error: {e}")
+    else:
+        questions = [(args.qname, args.qtype)]
+
+    try:
+        for qname, qtype in questions:
+            if args.batch:
+                print(f"\n;; {qname} {qtype}")
+            result = resolver.resolve(qname, qtype)
+            if result.response is None:
+                print("Request timed out")
+            else:
+                print_response(result.response)
+            if result.from_cache:
+                print("\n;; answered from the cache")
+                continue
+            print(
+                f"\n;; {result.queries} round trips, {result.referrals} referrals, "
+                f"{result.restarts} CNAME restarts, {result.cached} from cached delegations"
+            )
+    except KeyboardInterrupt:
+        print("\nExiting...")
+    finally:
+        resolver.close()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        usage="python3 client.py server_port qname qtype timeout\n"
+        "       python3 client.py server_port --batch FILE timeout [options]\n"
+        "       python3 client.py server_port qname qtype timeout --iterative --ns NAME=PORT ...",
+    )
+    parser.add_argument("server_port", type=int)
+    parser.add_argument("query", nargs="*", metavar="qname qtype timeout")
+    parser.add_argument(
+        "--batch", metavar="FILE", help='"qname qtype" lines to resolve, - for stdin'
+    )
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW)
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES)
+    parser.add_argument(
+        "--cache", metavar="FILE", help="reuse answers saved in FILE by earlier runs"
+    )
+    parser.add_argument(
+        "--cache-ttl", type=float, default=DEFAULT_CACHE_TTL, metavar="SECONDS"
+    )
+    parser.add_argument(
+        "--iterative",
+        action="store_true",
+        help="follow referrals from server_port to the servers given by --ns",
+    )
+    parser.add_argument(
+        "--ns",
+        action="append",
+        default=[],
+        metavar="NAME=PORT",
+        help="the local port of a nameserver, by name or glue address",
+    )
+    args = parser.parse_intermixed_args(argv)
+
+    if args.window < 1:
+        sys.exit("Error: --window must be at least 1.")
+    if args.retries < 0:
+        sys.exit("Error: --retries must not be negative.")
+
+    expected = 1 if args.batch else 3
+    if len(args.query) != expected:
         print(
             "\n===== Error usage, python3 client.py server_port qname qtype timeout ======\n"
         )
         exit(0)
+    if args.batch:
+        args.timeout = float(args.query[0])
+    else:
+        args.qname, args.qtype = args.query[:2]
+        args.timeout = int(args.query[2])
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+
+    cache = open_cache(args)
+    if args.iterative:
+        run_iterative(args, cache)
+        save_cache(cache)
+        exit(0)
+    if args.batch:
+        run_batch(args, cache)
+        save_cache(cache)
+        exit(0)
 
-    client = Client(int(sys.argv[1]), sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    client = Client(args.server_port, args.qname, args.qtype, args.timeout, cache=cache)
     try:
         client.run()
     except KeyboardInterrupt:
         print("\nExiting...")
+    save_cache(cache)
@@ -16,9 +16,9 @@
     With reference to template material from Rui Li (Tutor for COMP3331/9331)
     https://github.com/lrlrlrlr/COMP3331_9331_23T1_Labs/tree/main/demo%20w8
 """
-from io import BytesIO
 import json
 from pathlib import Path
+from dataclasses import dataclass
 import threading
 import datetime, time  # to calculate the time delta of packet transmission
 import logging, sys  # to write the log
@@ -27,108 +27,1002 @@ from threading import (
     Thread,
 )
 import random  # for flp and rlp function
+import queue  # bounded input queue for the worker pool
+import argparse
+import asyncio
+import heapq
+import itertools
+import select
+import collections
+import concurrent.futures
+import os
+import signal
 
 import struct
 
+from zonefile import (
+    DNSCache,
+    CNAMEIndex,
+    NameserverIndex,
+    ZoneSnapshot,
+    changed_names,
+    read_master_file,
+)
 from classes import (
     DNSHeader,
     DNSQuestion,
     DNSRecord,
     DNSResponse,
     BUFFERSIZE,
+    FLAG_QUERY,
     FLAG_RESPONSE,
+    HEADER_SIZE,
     get_qtype,
     TYPE_A,
     TYPE_CNAME,
     TYPE_NS,
     TYPE_INVALID,
     get_qtype,
+    name_cache_stats,
+    parse_query,
 )
 
 MASTER_FILE = "master.txt"
 
+# how incoming datagrams are handed to handle_query
+DISPATCH_THREAD = "thread"  # one new thread per datagram
+DISPATCH_POOL = "pool"  # fixed-size worker pool fed by a bounded queue
+# one thread drains the socket in batches and flushes replies together
+DISPATCH_BATCH = "batch"
+
+# what the pool does when its queue is full
+OVERFLOW_DROP = "drop"  # discard the datagram and count it
+OVERFLOW_BLOCK = "block"  # stall the receive loop until a slot frees up
+
+# which event model drives the server
+ENGINE_THREADED = "threaded"  # blocking socket, see --dispatch
+ENGINE_ASYNCIO = "asyncio"  # single asyncio event loop, see AsyncServer
+
+DEFAULT_RESPONSE_CACHE_SIZE = 65536
+
+DEFAULT_BATCH_SIZE = 64  # most datagrams read before the batch is answered
+
+DEFAULT_RING_SLOTS = 256  # receive buffers kept for recvfrom_into
+
+DEFAULT_POOL_SIZE = 32
+DEFAULT_QUEUE_SIZE = 1024
+
+# forwarding names the zone doesn't answer to an upstream server
+DEFAULT_UPSTREAM_SOCKETS = 8
+DEFAULT_SOCKET_USES = 256  # queries sent from one source port before it is replaced
+DEFAULT_FORWARD_TIMEOUT = 6.0  # above the upstream's 0-4s simulated delay
+DEFAULT_FORWARD_CACHE_SIZE = 16384
+DEFAULT_FORWARD_TTL = 300.0  # responses carry no TTLs, every entry lives this long
+MAX_QID = 2**16 - 1
+
+
+class CachedResponse:
+    def __init__(self, response: DNSResponse) -> None:
+        """
+        A response encoded once, everything except the QID and the echoed question.
+
+        :param response: The response built for the lowercased question.
+        """
+        message = response.to_bytes()
+        self.question = response.question[0]
+        question_end = HEADER_SIZE + len(self.question.to_bytes())
+        self.header_tail = message[2:HEADER_SIZE]  # flags and section counts
+        self.question_bytes = message[HEADER_SIZE:question_end]
+        # every name the response was built from, a zone update touching one of
+        # them or one of their ancestors (a new delegation) makes it stale
+        self.names = frozenset(
+            name.lower()
+            for record in response.answer + response.authority + response.additional
+            for name in (
+                (record.name, record.data)
+                if record.type_ in (TYPE_NS, TYPE_CNAME)
+                else (record.name,)
+            )
+        ).union((self.question.qname.lower(),))
+        self.answered = bool(response.answer)  # False for a referral
+        # compressed, its pointers may point into the question
+        self.body = message[question_end:]
+
+    def depends_on(self, changed: set) -> bool:
+        for name in self.names:
+            while True:
+                if name in changed:
+                    return True
+                if name == ".":
+                    break
+                # "www.example.com." -> "example.com." -> "com." -> "."
+                name = name.partition(".")[2] or "."
+        return False
+
+    def render(self, qid: int, question: DNSQuestion) -> bytes:
+        question_bytes = self.question_bytes
+        if question.qname != self.question.qname:
+            # echo the question exactly as the client cased it, owner names that
+            # point into it come out in the same case. The pointers after it only
+            # stay valid if it is as long as the question they were made for.
+            echoed = question.to_bytes()
+            if len(echoed) == len(question_bytes):
+                question_bytes = echoed
+        return struct.pack("!H", qid) + self.header_tail + question_bytes + self.body
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = DEFAULT_RESPONSE_CACHE_SIZE) -> None:
+        """
+        Encoded responses keyed by (lowercased qname, qtype), safe to share between
+        worker threads.
+
+        :param max_entries: The most responses kept, the oldest is evicted first.
+        """
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()  # oldest first
+        self.lock = threading.Lock()
+        self.version = None  # the DNSCache version the entries were built from
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version: int) -> CachedResponse | None:
+        with self.lock:
+            if version != self.version:
+                # zone data changed, everything encoded so far may be wrong
+                self.entries = collections.OrderedDict()
+                self.version = version
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, key, version: int, entry: CachedResponse) -> None:
+        with self.lock:
+            if version != self.version:
+                return
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def updated(self, version: int, changed: set) -> "ResponseCache":
+        """
+        A copy holding the entries that don't depend on a changed name, for a zone
+        at version.
+
+        :param version: The DNSCache version of the updated zone.
+        :param changed: The lowercased names whose records changed.
+        """
+        with self.lock:
+            entries = list(self.entries.items())
+        responses = ResponseCache(self.max_entries)
+        responses.version = version
+        responses.entries = collections.OrderedDict(
+            (key, entry) for key, entry in entries if not entry.depends_on(changed)
+        )
+        return responses
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class ForwardCache:
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_FORWARD_CACHE_SIZE,
+        ttl: float = DEFAULT_FORWARD_TTL,
+    ) -> None:
+        """
+        Upstream responses keyed by (lowercased qname, qtype), least recently used
+        evicted first. Each entry expires ttl seconds after it was stored.
+
+        :param max_entries: The most responses kept.
+        :param ttl: Seconds a response is served without asking upstream again.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (expires, CachedResponse), least recently used first
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> CachedResponse | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, entry: CachedResponse) -> None:
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, entry)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class UpstreamPool:
+    def __init__(
+        self,
+        upstream_address: tuple,
+        num_sockets: int = DEFAULT_UPSTREAM_SOCKETS,
+        timeout: float = DEFAULT_FORWARD_TIMEOUT,
+        max_uses: int = DEFAULT_SOCKET_USES,
+    ) -> None:
+        """
+        A few UDP sockets for querying one upstream server, each checked out by one
+        query at a time. Every query has a random QID and every socket a random
+        source port, replaced after max_uses queries.
+
+        :param upstream_address: The (host, port) queries are sent to.
+        :param num_sockets: The most upstream queries in flight, others wait for a socket.
+        :param timeout: Seconds to wait for the upstream's reply.
+        :param max_uses: Queries sent from a socket before it is closed and reopened.
+        """
+        if num_sockets < 1:
+            raise ValueError("num_sockets must be at least 1")
+        self.upstream_address = upstream_address
+        self.timeout = timeout
+        self.max_uses = max_uses
+        self.num_sockets = num_sockets
+        self.idle = queue.Queue()  # [socket, uses]
+        for _ in range(num_sockets):
+            self.idle.put([self.open_socket(), 0])
+
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.timeouts = 0
+        self.reopened = 0
+
+    @staticmethod
+    def open_socket() -> socket.socket:
+        upstream_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        for _ in range(8):
+            try:
+                upstream_socket.bind(("127.0.0.1", random.randint(1024, 65535)))
+                return upstream_socket
+            except OSError:
+                continue  # in use, try another
+        upstream_socket.bind(("127.0.0.1", 0))
+        return upstream_socket
+
+    def query(self, question: DNSQuestion) -> DNSResponse | None:
+        """
+        Send question upstream and wait for the reply, None if it timed out.
+        """
+        slot = self.idle.get()
+        try:
+            upstream_socket = slot[0]
+            qid = random.randint(1, MAX_QID)
+            question_bytes = question.to_bytes()
+            header = DNSHeader(qid=qid, flags=FLAG_QUERY, num_questions=1)
+            upstream_socket.sendto(
+                header.to_bytes() + question_bytes, self.upstream_address
+            )
+            slot[1] += 1
+            with self._lock:
+                self.sent += 1
 
-class DNSCache:
-    def __init__(self):
-        self.cache = {}
+            deadline = time.monotonic() + self.timeout
+            question_end = HEADER_SIZE + len(question_bytes)
+            while (remaining := deadline - time.monotonic()) > 0:
+                upstream_socket.settimeout(remaining)
+                try:
+                    data, address = upstream_socket.recvfrom(BUFFERSIZE)
+                except socket.timeout:
+                    break
+                except ConnectionRefusedError:
+                    break  # nothing listening upstream
+                # late replies to queries that timed out on this socket don't match
+                if (
+                    address != self.upstream_address
+                    or len(data) < question_end
+                    or struct.unpack_from("!H", data)[0] != qid
+                    or data[HEADER_SIZE:question_end] != question_bytes
+                ):
+                    continue
+                try:
+                    return DNSResponse.from_bytes(data)
+                except ValueError:
+                    continue
+            with self._lock:
+                self.timeouts += 1
+            return None
+        finally:
+            if slot[1] >= self.max_uses:
+                slot[0].close()
+                slot[:] = [self.open_socket(), 0]
+                with self._lock:
+                    self.reopened += 1
+            self.idle.put(slot)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sent": self.sent,
+                "timeouts": self.timeouts,
+                "reopened": self.reopened,
+                "idle_sockets": self.idle.qsize(),
+            }
+
+    def close(self) -> None:
+        while not self.idle.empty():
+            self.idle.get_nowait()[0].close()
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        """
+        Runs a call once for every caller asking for the same key at the same time:
+        the first one makes it, the rest wait for its result.
+        """
+        self.calls = {}  # key -> concurrent.futures.Future of the call in flight
+        self.lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, call):
+        """
+        call(), or the result of the identical call already in flight for key.
+        Exceptions are raised in every waiting caller.
+        """
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = concurrent.futures.Future()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
 
-    def get_cache(self):
-        return self.cache
+        try:
+            result = call()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            # later callers start a new call, and by then the result is cached
+            with self.lock:
+                del self.calls[key]
 
-    def add_record(self, qname: str, qtype: str, record: str):
-        qname = qname.lower()
-        if qname not in self.cache:
-            self.cache[qname] = {}
-        if qtype not in self.cache[qname]:
-            self.cache[qname][qtype] = []
-        self.cache[qname][qtype].append(record)
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "in_flight": len(self.calls),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+            }
 
-    def get_records(self, qname: str, qtype: str) -> list:
-        qname = qname.lower()
-        return self.cache.get(qname, {}).get(qtype, [])
+
+class Forwarder:
+    def __init__(
+        self,
+        upstream_port: int,
+        num_sockets: int = DEFAULT_UPSTREAM_SOCKETS,
+        cache_size: int = DEFAULT_FORWARD_CACHE_SIZE,
+        ttl: float = DEFAULT_FORWARD_TTL,
+        timeout: float = DEFAULT_FORWARD_TIMEOUT,
+    ) -> None:
+        """
+        Answers questions the zone can't from an upstream server, such as another
+        instance of this one, keeping them in a ForwardCache. Identical questions
+        that miss the cache together share one upstream query.
+
+        :param upstream_port: The UDP port the upstream server listens on at 127.0.0.1.
+        :param num_sockets: The size of the UpstreamPool.
+        :param cache_size: The most upstream responses cached.
+        :param ttl: Seconds an upstream response is cached.
+        :param timeout: Seconds to wait for the upstream's reply.
+        """
+        self.upstream = UpstreamPool(
+            ("127.0.0.1", int(upstream_port)), num_sockets, timeout
+        )
+        self.cache = ForwardCache(cache_size, ttl)
+        self.in_flight = SingleFlight()
+
+    def forward(self, qid: int, question: DNSQuestion) -> bytes | None:
+        """
+        The upstream's answer to question, addressed to qid, or None if it didn't reply.
+        """
+        key = (question.key(), question.qtype)
+        entry = self.cache.get(key)
+        if entry is None:
+            entry = self.in_flight.do(key, lambda: self.fetch(key))
+            if entry is None:
+                return None
+        # one encoded response for every waiter, each gets its own QID and casing
+        return entry.render(qid, question)
+
+    def fetch(self, key) -> CachedResponse | None:
+        response = self.upstream.query(DNSQuestion(key[0], key[1]))
+        if response is None:
+            return None
+        entry = CachedResponse(response)
+        self.cache.put(key, entry)
+        return entry
+
+    def stats(self) -> dict:
+        return {
+            "cache": self.cache.stats(),
+            "upstream": self.upstream.stats(),
+            "in_flight": self.in_flight.stats(),
+        }
+
+
+@dataclass
+class Zone:
+    """
+    Everything a query reads, swapped as one reference on reload.
+    """
+
+    cache: DNSCache
+    cname_index: CNAMEIndex
+    ns_index: NameserverIndex
+    responses: ResponseCache
+    source: str  # the master file or snapshot it was loaded from
+
+
+class WorkerPool:
+    def __init__(
+        self,
+        handler,
+        num_workers: int = DEFAULT_POOL_SIZE,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        overflow: str = OVERFLOW_DROP,
+    ) -> None:
+        """
+        A fixed set of worker threads pulling jobs off a bounded queue.
+
+        :param handler: The callable each worker runs for every job.
+        :param num_workers: The number of worker threads to start.
+        :param queue_size: The maximum number of jobs waiting for a worker.
+        :param overflow: OVERFLOW_DROP or OVERFLOW_BLOCK, applied when the queue is full.
+        """
+        if num_workers < 1:
+            raise ValueError("num_workers must be at least 1")
+        if queue_size < 1:
+            raise ValueError("queue_size must be at least 1")
+        if overflow not in (OVERFLOW_DROP, OVERFLOW_BLOCK):
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+
+        self.handler = handler
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.jobs = queue.Queue(maxsize=queue_size)
+
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.dropped = 0
+        self.processed = 0
+        self.max_depth = 0
+
+        self.workers = [
+            Thread(target=self.work, name=f"dns-worker-{i}", daemon=True)
+            for i in range(num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, *args) -> bool:
+        """
+        Queue a job for the workers, returns False if it was dropped.
+        """
+        try:
+            if self.overflow == OVERFLOW_BLOCK:
+                self.jobs.put(args)
+            else:
+                self.jobs.put_nowait(args)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+
+        depth = self.jobs.qsize()
+        with self._lock:
+            self.submitted += 1
+            if depth > self.max_depth:
+                self.max_depth = depth
+        return True
+
+    def work(self) -> None:
+        while True:
+            args = self.jobs.get()
+            if args is None:  # shutdown sentinel
+                break
+            try:
+                self.handler(*args)
+            except Exception as e:
+                logging.error(f"Error in worker: {e}")
+            finally:
+                with self._lock:
+                    self.processed += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.num_workers,
+                "queue_size": self.queue_size,
+                "queue_depth": self.jobs.qsize(),
+                "max_depth": self.max_depth,
+                "submitted": self.submitted,
+                "processed": self.processed,
+                "dropped": self.dropped,
+            }
+
+    def shutdown(self) -> None:
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+class BufferRing:
+    def __init__(
+        self, slots: int = DEFAULT_RING_SLOTS, slot_size: int = BUFFERSIZE
+    ) -> None:
+        """
+        Preallocated receive buffers, each datagram borrows a slot until it is parsed.
+
+        :param slots: The number of buffers.
+        :param slot_size: The size of each buffer, the largest datagram accepted.
+        """
+        self.views = [memoryview(bytearray(slot_size)) for _ in range(slots)]
+        self.free = collections.deque(range(slots))  # append/popleft are thread-safe
+        self.exhausted = 0  # receives that found every slot busy
+
+    def acquire(self) -> int | None:
+        try:
+            return self.free.popleft()
+        except IndexError:
+            self.exhausted += 1
+            return None
+
+    def release(self, slot: int) -> None:
+        self.free.append(slot)
+
+    def stats(self) -> dict:
+        return {
+            "slots": len(self.views),
+            "free": len(self.free),
+            "exhausted": self.exhausted,
+        }
 
 
 class Server:
-    def __init__(self, server_port: int) -> None:
+    def __init__(
+        self,
+        server_port: int,
+        dispatch: str = DISPATCH_THREAD,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        overflow: str = OVERFLOW_DROP,
+        reuse_port: bool = False,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        load_processes: int = 1,
+        snapshot: str | None = None,
+        watch_interval: float = 0,
+        forwarder: Forwarder | None = None,
+    ) -> None:
         """
         The server receives DNS query from the sender via UDP
 
         :param server_port: The UDP port number on which the server is listening.
+        :param dispatch: DISPATCH_THREAD to start a thread per datagram, DISPATCH_POOL to use a WorkerPool, or DISPATCH_BATCH to read and answer datagrams in batches.
+        :param pool_size: The number of worker threads when dispatch is DISPATCH_POOL.
+        :param queue_size: The maximum number of queued datagrams when dispatch is DISPATCH_POOL.
+        :param overflow: What the pool does with a datagram when its queue is full.
+        :param reuse_port: Set SO_REUSEPORT so several processes can bind the same port.
+        :param batch_size: The most datagrams read per batch when dispatch is DISPATCH_BATCH.
+        :param load_processes: The number of processes parsing the master file.
+        :param snapshot: Serve from this compiled zone snapshot instead of the master file.
+        :param watch_interval: Reload the zone when its file changes, checked every this many seconds (0 to disable).
+        :param forwarder: Where questions the zone has no answer for are sent, instead of answering with a referral.
         """
+        if forwarder is not None and dispatch == DISPATCH_BATCH:
+            # the batch loop is a single thread, an upstream wait would stall it
+            raise ValueError("Forwarding is not supported with batch dispatch")
+        self.forwarder = forwarder
         self.address = "127.0.0.1"
         self.server_port = int(server_port)
         self.server_address = (self.address, self.server_port)
+        self.reuse_port = reuse_port
+        self.load_processes = load_processes
+
+        self.server_socket = self.create_socket()
+
+        # creating DNS cache
+        self.snapshot = snapshot
+        try:
+            self.zone = self.load_zone()
+        except (OSError, ValueError) as e:
+            sys.exit(f"Error: {e}")
+        # one reload at a time, queries never take it
+        self.reload_lock = threading.Lock()
+        self.reloads = 0
+        self.watch_interval = watch_interval
 
+        if dispatch == DISPATCH_POOL:
+            self.pool = WorkerPool(self.handle_query, pool_size, queue_size, overflow)
+        elif dispatch in (DISPATCH_THREAD, DISPATCH_BATCH):
+            self.pool = None
+        else:
+            raise ValueError(f"Unknown dispatch mode: {dispatch}")
+        self.dispatch = dispatch
+        self.batch_size = batch_size
+        # receive buffers for our own socket, an event loop brings its own
+        self.ring = BufferRing() if self.server_socket is not None else None
+        self.batches = 0
+        self.batched_datagrams = 0
+
+    def create_socket(self) -> socket.socket:
         # init the UDP socket
         # define socket for the server side and bind address
-        self.server_socket = socket.socket(
-            family=socket.AF_INET, type=socket.SOCK_DGRAM
-        )
-        self.server_socket.bind(self.server_address)
+        server_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        if self.reuse_port:
+            # let the kernel spread datagrams across every worker bound to this port
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind(self.server_address)
+        return server_socket
 
-        # creating DNS cache
-        self.cache = DNSCache()
-        self.load_records(MASTER_FILE)
+    def load_zone(self) -> Zone:
+        if self.snapshot is not None:
+            return self.load_snapshot(self.snapshot)
+        return self.load_records(MASTER_FILE)
+
+    def update_records(self, filename: str, zone: Zone) -> Zone:
+        """
+        Load the master file again and carry over everything from zone that the
+        edits didn't touch: the indexes are updated for the changed names only and
+        cached responses that don't depend on them are kept.
+        """
+        if not Path(filename).exists():
+            raise FileNotFoundError(f"{filename} does not exist.")
+
+        start = time.perf_counter()
+        cache = DNSCache()
+        cache.add_records(read_master_file(filename, processes=self.load_processes))
+        changed = changed_names(zone.cache, cache)
+        cache.version = zone.cache.version + 1
 
-    def load_records(self, filename: str):
+        cname_index = zone.cname_index.updated(cache, changed)
+        ns_index = zone.ns_index.updated(cache, changed)
+        responses = zone.responses.updated(cache.version, changed)
+
+        elapsed = time.perf_counter() - start
+        print(
+            f"Updated {len(changed)} names from {filename} in {elapsed:.3f}s, "
+            f"kept {len(responses.entries)} of {len(zone.responses.entries)} cached responses"
+        )
+        return Zone(cache, cname_index, ns_index, responses, filename)
+
+    def load_records(self, filename: str) -> Zone:
         filepath = Path(filename)
 
         if not filepath.exists():
-            sys.exit(f"Error: {filename} does not exist.")
+            raise FileNotFoundError(f"{filename} does not exist.")
+
+        start = time.perf_counter()
+        cache = DNSCache()
+        count = cache.add_records(
+            read_master_file(filename, processes=self.load_processes)
+        )
+        cname_index = CNAMEIndex()
+        cname_index.build(cache)
+        ns_index = NameserverIndex()
+        ns_index.build(cache)
 
-        with open(filename, "r") as f:
-            for line in f:
-                qname, qtype, record = line.split()
-                self.cache.add_record(qname, qtype, record)
+        elapsed = time.perf_counter() - start
+        rate = count / elapsed if elapsed > 0 else 0
+        print(
+            f"Loaded {count} records from {filename} in {elapsed:.3f}s ({rate:.0f} records/s)"
+        )
+        return Zone(cache, cname_index, ns_index, ResponseCache(), filename)
+
+    def load_snapshot(self, filename: str) -> Zone:
+        if not Path(filename).exists():
+            raise FileNotFoundError(f"{filename} does not exist.")
+
+        start = time.perf_counter()
+        snapshot = ZoneSnapshot(filename)
+
+        elapsed = time.perf_counter() - start
+        print(
+            f"Mapped {snapshot.num_entries} entries from {filename} in {elapsed * 1000:.1f}ms"
+        )
+        return Zone(
+            snapshot.cache,
+            snapshot.cname_index,
+            snapshot.ns_index,
+            ResponseCache(),
+            filename,
+        )
+
+    # the current zone's parts, each query should read self.zone once instead
+    @property
+    def cache(self):
+        return self.zone.cache
+
+    @property
+    def cname_index(self):
+        return self.zone.cname_index
+
+    @property
+    def ns_index(self):
+        return self.zone.ns_index
+
+    @property
+    def responses(self):
+        return self.zone.responses
+
+    def reload(self) -> bool:
+        """
+        Build a new zone from its file and swap it in. Queries already running keep
+        the zone they started with, a failed load leaves the current zone serving.
+        """
+        with self.reload_lock:
+            current = self.zone
+            try:
+                if self.snapshot is None and self.incremental(current):
+                    zone = self.update_records(MASTER_FILE, current)
+                else:
+                    zone = self.load_zone()
+            except Exception as e:
+                logging.error(
+                    f"Zone reload failed, still serving {self.zone.source}: {e}"
+                )
+                return False
+            self.zone = zone  # a single reference assignment, atomic for readers
+            self.reloads += 1
+            return True
+
+    @staticmethod
+    def incremental(zone: Zone) -> bool:
+        # only a master file zone whose indexes are up to date can be updated in place
+        return (
+            isinstance(zone.cache, DNSCache)
+            and zone.cname_index.version == zone.cache.version
+            and zone.ns_index.version == zone.cache.version
+        )
+
+    def reload_in_background(self) -> None:
+        Thread(target=self.reload, name="zone-reload", daemon=True).start()
+
+    def watch_zone(self) -> None:
+        """
+        Poll the zone file's mtime and reload when it changes.
+        """
+        last_mtime = self.zone_mtime()
+        while True:
+            time.sleep(self.watch_interval)
+            mtime = self.zone_mtime()
+            if mtime is not None and mtime != last_mtime:
+                last_mtime = mtime
+                self.reload()
+
+    def zone_mtime(self) -> float | None:
+        try:
+            return os.stat(self.snapshot or MASTER_FILE).st_mtime
+        except OSError:
+            return None
+
+    def enable_reload(self) -> None:
+        """
+        Reload on SIGHUP, and start the mtime watcher if watch_interval is set.
+        Call from the main thread.
+        """
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(
+                signal.SIGHUP, lambda signum, frame: self.reload_in_background()
+            )
+        if self.watch_interval > 0:
+            Thread(target=self.watch_zone, name="zone-watch", daemon=True).start()
 
     def run(self) -> None:
+        if self.dispatch == DISPATCH_BATCH:
+            self.run_batched()
+            return
+
         while True:
+            release = None
             try:
-                incoming_message, client_address = self.server_socket.recvfrom(
-                    BUFFERSIZE
-                )
-                thread = threading.Thread(
-                    target=self.handle_query, args=(incoming_message, client_address)
-                )
-                thread.start()
+                incoming_message, client_address, release = self.receive()
+                if self.pool is not None:
+                    if not self.pool.submit(incoming_message, client_address, release):
+                        release()
+                else:
+                    thread = threading.Thread(
+                        target=self.handle_query,
+                        args=(incoming_message, client_address, release),
+                    )
+                    thread.start()
             except Exception as e:
                 logging.error(f"Error in main loop: {e}")
+                if release is not None:
+                    release()
+
+    def receive(self) -> tuple:
+        """
+        Receive one datagram into a free ring slot.
 
-    def handle_query(self, incoming_message, client_address) -> None:
+        :return: A memoryview of the datagram, the client address, and a callable
+            that hands the slot back once the datagram has been parsed.
+        """
+        slot = self.ring.acquire()
+        if slot is None:
+            # every slot is busy, fall back to a fresh buffer
+            incoming_message, client_address = self.server_socket.recvfrom(BUFFERSIZE)
+            return incoming_message, client_address, self.release_nothing
+
+        view = self.ring.views[slot]
+        try:
+            nbytes, client_address = self.server_socket.recvfrom_into(view)
+        except BaseException:
+            self.ring.release(slot)
+            raise
+        return view[:nbytes], client_address, lambda: self.ring.release(slot)
+
+    @staticmethod
+    def release_nothing() -> None:
+        pass
+
+    def run_batched(self) -> None:
+        """
+        Single-threaded loop: wait for the socket, read until it would block (or
+        batch_size datagrams), answer them all, then send every reply that is due.
+        The simulated delay schedules the reply instead of sleeping.
+        """
+        self.server_socket.setblocking(False)
+        pending = []  # heap of (send_at, seq, response, client_address, qid, question)
+        seq = itertools.count()  # tie-breaker so the heap never compares addresses
+
+        while True:
+            try:
+                timeout = None
+                if pending:
+                    timeout = max(0.0, pending[0][0] - time.monotonic())
+                readable, _, _ = select.select([self.server_socket], [], [], timeout)
+
+                if readable:
+                    batch = self.receive_batch()
+                    self.batches += 1
+                    self.batched_datagrams += len(batch)
+                    for incoming_message, client_address, release in batch:
+                        try:
+                            replies = self.answer_datagram(
+                                incoming_message, client_address
+                            )
+                        finally:
+                            release()
+                        for reply in replies:
+                            heapq.heappush(pending, (reply[0], next(seq)) + reply[1:])
+
+                self.flush_replies(pending)
+            except Exception as e:
+                logging.error(f"Error in main loop: {e}")
+
+    def receive_batch(self) -> list:
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.receive())
+            except (BlockingIOError, InterruptedError):
+                break
+        return batch
+
+    def answer_datagram(self, incoming_message, client_address) -> list:
+        """
+        Answer every question in a datagram without sending anything.
+
+        :return: (send_at, response, client_address, qid, question) for each question.
+        """
+        received_time = datetime.datetime.now()
+        try:
+            header, questions = parse_query(incoming_message)
+        except ValueError as e:
+            logging.error(f"Dropping malformed query from {client_address}: {e}")
+            return []
+
+        replies = []
+        for question in questions:
+            # simulate delay, the reply waits in the pending heap
+            delay = random.randint(0, 4)
+            self.log_received(
+                received_time, client_address, header.qid, question, delay
+            )
+            response = self.process_query(header.qid, question)
+            replies.append(
+                (
+                    time.monotonic() + delay,
+                    response or b"",
+                    client_address,
+                    header.qid,
+                    question,
+                )
+            )
+        return replies
+
+    def flush_replies(self, pending: list) -> None:
+        now = time.monotonic()
+        while pending and pending[0][0] <= now:
+            _, _, response, client_address, qid, question = heapq.heappop(pending)
+            try:
+                self.server_socket.sendto(response, client_address)
+            except BlockingIOError:
+                logging.error(f"Send buffer full, dropping reply to {client_address}")
+                continue
+            self.log_sent(client_address, qid, question)
+
+    def stats(self) -> dict:
+        """
+        Dispatch counters, the queue depth and drop counts come from the pool.
+        """
+        stats = {
+            "dispatch": self.dispatch,
+            "responses": self.responses.stats(),
+            "ring": self.ring.stats(),
+            "reloads": self.reloads,
+            "names": name_cache_stats(),
+        }
+        if self.forwarder is not None:
+            stats["forwarder"] = self.forwarder.stats()
+        if self.pool is not None:
+            stats.update(self.pool.stats())
+        if self.dispatch == DISPATCH_BATCH:
+            stats["batches"] = self.batches
+            stats["batched_datagrams"] = self.batched_datagrams
+        return stats
+
+    def handle_query(self, incoming_message, client_address, release=None) -> None:
         """
         This function tries to receive any incoming message from the client
+
+        :param release: Called once the message is parsed, so the buffer it lives in can be reused.
         """
         try:
             received_time = datetime.datetime.now()
-            header = DNSHeader.parse_header(BytesIO(incoming_message[:12]))
+            try:
+                header, questions = parse_query(incoming_message)
+            except ValueError as e:
+                logging.error(f"Dropping malformed query from {client_address}: {e}")
+                return
+            finally:
+                if release is not None:
+                    release()
 
-            questions = self.parse_questions(incoming_message, header.num_questions)
             if questions:
                 for question in questions:
                     # simulate delay to test multithreading
                     delay = random.randint(0, 4)
-                    print(
-                        f"{received_time.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]} rcv {client_address[1]:<5}: {header.qid:<4} {question.qname:<15} {get_qtype(question.qtype):<5} (delay: {delay}s)"
+                    self.log_received(
+                        received_time, client_address, header.qid, question, delay
                     )
 
                     time.sleep(delay)
@@ -136,28 +1030,56 @@ class Server:
                     response = self.process_query(header.qid, question)
                     self.server_socket.sendto(response or b"", client_address)
 
-                    sent_time = datetime.datetime.now()
-                    print(
-                        f"{sent_time.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]} snd {client_address[1]:<5}: {header.qid:<4} {question.qname:<15} {get_qtype(question.qtype)}"
-                    )
+                    self.log_sent(client_address, header.qid, question)
 
         except Exception as e:
             logging.error(f"Error handling query: {e}")
 
-    def parse_questions(self, message, qdcount):
-        try:
-            offset = 12
-            questions = []
-            for _ in range(qdcount):
-                qname, offset = self.decode_qname(message, offset)
-                qtype = struct.unpack("!H", message[offset : offset + 2])[0]
-                offset += 2  # 2 bytes for QTYPE
-                questions.append(DNSQuestion(qname, qtype))
-            return questions
-        except Exception as e:
-            logging.error(f"Error parsing question: {e}")
+    @staticmethod
+    def log_received(received_time, client_address, qid, question, delay) -> None:
+        print(
+            f"{received_time.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]} rcv {client_address[1]:<5}: {qid:<4} {question.qname:<15} {get_qtype(question.qtype):<5} (delay: {delay}s)"
+        )
+
+    @staticmethod
+    def log_sent(client_address, qid, question) -> None:
+        sent_time = datetime.datetime.now()
+        print(
+            f"{sent_time.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]} snd {client_address[1]:<5}: {qid:<4} {question.qname:<15} {get_qtype(question.qtype)}"
+        )
+
+    def local_response(self, question: DNSQuestion) -> CachedResponse | None:
+        """
+        The zone's response to question, encoded once and cached.
+        """
+        zone = self.zone  # stay on this zone even if a reload swaps it mid-query
+        key = (question.key(), question.qtype)
+        version = zone.cache.version
+        entry = zone.responses.get(key, version)
+        if entry is None:
+            response = self.build_response(DNSQuestion(key[0], question.qtype), zone)
+            if response is None:
+                return None
+            entry = CachedResponse(response)
+            zone.responses.put(key, version, entry)
+        return entry
 
     def process_query(self, qid: int, question: DNSQuestion) -> bytes | None:
+        entry = self.local_response(question)
+        if entry is None:
+            return None
+        if self.forwarder is not None and not entry.answered:
+            forwarded = self.forwarder.forward(qid, question)
+            if forwarded is not None:
+                return forwarded
+            # upstream didn't reply, the local referral is the best we have
+        return entry.render(qid, question)
+
+    def build_response(
+        self, question: DNSQuestion, zone: Zone | None = None
+    ) -> DNSResponse | None:
+        if zone is None:
+            zone = self.zone
         try:
             qname = question.qname
             qtype = get_qtype(question.qtype)
@@ -166,35 +1088,21 @@ class Server:
                 raise ValueError("Invalid qtype")
 
             answers = []
-            cname_chain = []
 
-            # Loop to handle CNAME chaining
-            while True:
-                answers_str = self.cache.get_records(qname, qtype)
-                if answers_str:
-                    answers.extend(
-                        [
-                            DNSRecord(
-                                name=qname,
-                                type_=question.qtype,
-                                data=answer,
-                            )
-                            for answer in answers_str
-                        ]
-                    )
-                    break  # Exit loop if found answer
-
-                if qtype != TYPE_CNAME:
-                    cname_records = self.cache.get_records(qname, "CNAME")
-                    if cname_records:
-                        cname_record = cname_records[0]
-                        answers.append(
-                            DNSRecord(name=qname, type_=TYPE_CNAME, data=cname_record)
-                        )
-                        qname = cname_record  # Restart the query with the new CNAME
-                        cname_chain.append(qname)  # Track CNAME chain
-                    else:
-                        break  # Exit loop if no CNAME found and no final answer
+            answers_str = zone.cache.get_records(qname, qtype)
+            if answers_str:
+                answers = [
+                    DNSRecord(name=qname, type_=question.qtype, data=answer)
+                    for answer in answers_str
+                ]
+            elif qtype != "CNAME":
+                # CNAME chains are flattened by load_records, rebuild if records were added since
+                if zone.cname_index.version != zone.cache.version:
+                    zone.cname_index.build(zone.cache)
+                chain = zone.cname_index.get(qname, qtype)
+                if chain:
+                    answers = chain.records + chain.answers
+                    qname = chain.terminal  # referrals are for the end of the chain
 
             authority = []
             additional = []
@@ -205,10 +1113,10 @@ class Server:
                     contains_record = True
                     break
             if not contains_record:
-                ns_records = self.find_closest_nameservers(qname)
+                ns_records = self.find_closest_nameservers(qname, zone)
                 authority = ns_records
                 for ns_record in ns_records:
-                    additional_record_name = self.cache.get_records(ns_record.data, "A")
+                    additional_record_name = zone.cache.get_records(ns_record.data, "A")
                     if additional_record_name:
                         additional_records = [
                             DNSRecord(name=ns_record.data, type_=TYPE_A, data=ad)
@@ -217,7 +1125,7 @@ class Server:
                         additional.extend(additional_records)
 
             header = DNSHeader(
-                qid=qid,
+                qid=0,  # filled in per query by CachedResponse.render
                 flags=FLAG_RESPONSE,
                 num_questions=1,
                 num_answers=len(answers),
@@ -232,7 +1140,7 @@ class Server:
                 additional=additional,
             )
 
-            return response.to_bytes()
+            return response
         except Exception as e:
             logging.error(f"Error processing question: {e}")
 
@@ -265,49 +1173,337 @@ class Server:
         # no cname records or a records
         return answers
 
-    def find_closest_nameservers(self, qname: str):
-        ancestor_parts = qname.split(".")
+    def find_closest_nameservers(self, qname: str, zone: Zone | None = None):
+        if zone is None:
+            zone = self.zone
+        if zone.ns_index.version != zone.cache.version:
+            zone.ns_index.build(zone.cache)
+        return zone.ns_index.find(qname)
 
-        while ancestor_parts:
-            ancestor = ".".join(ancestor_parts)
-            ancestor = ancestor if ancestor else "."  # root domain
 
-            resolve_ns = self.cache.get_records(ancestor, "NS")
-            if resolve_ns:
-                ns_records = [
-                    DNSRecord(name=ancestor, type_=TYPE_NS, data=ns)
-                    for ns in resolve_ns
-                ]
-                return ns_records
+class DNSServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server: "AsyncServer") -> None:
+        self.server = server
 
-            ancestor_parts = ancestor_parts[1:]
+    def connection_made(self, transport) -> None:
+        self.server.transport = transport
 
-        # if no ancestors, return an empty list
-        return []
+    def datagram_received(self, data, addr) -> None:
+        self.server.spawn(self.server.handle_query_async(data, addr))
 
-    @staticmethod
-    def decode_qname(message, offset):
-        # print(message[offset:])
-        labels = []
-        while True:
-            length = message[offset]
-            if length == 0:  # If the length is 0, it indicates the end of the QNAME
-                offset += 1  # Move the offset past the null byte
-                break
-            labels.append(message[offset + 1 : offset + 1 + length].decode("ascii"))
-            offset += 1 + length
+    def error_received(self, exc) -> None:
+        logging.error(f"Error in datagram endpoint: {exc}")
 
-        qname = ".".join(labels) + "."  # Re-add the trailing dot
-        return qname, offset
 
+class AsyncServer(Server):
+    def __init__(
+        self,
+        server_port: int,
+        reuse_port: bool = False,
+        load_processes: int = 1,
+        snapshot: str | None = None,
+        watch_interval: float = 0,
+        forwarder: Forwarder | None = None,
+    ) -> None:
+        """
+        The same DNS server, driven by a single asyncio event loop instead of threads.
+        Queries are parsed with parse_query and answered from the zone on the loop,
+        only the forwarder's upstream waits run in threads of their own.
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("\n===== Error usage, python3 server.py server_port ======\n")
-        exit(0)
+        :param server_port: The UDP port number on which the server is listening.
+        :param reuse_port: Set SO_REUSEPORT so several processes can bind the same port.
+        :param load_processes: The number of processes parsing the master file.
+        :param snapshot: Serve from this compiled zone snapshot instead of the master file.
+        :param watch_interval: Reload the zone when its file changes, checked every this many seconds (0 to disable).
+        :param forwarder: Where questions the zone has no answer for are sent.
+        """
+        self.transport = None
+        # keep a reference so pending queries aren't garbage collected
+        self.tasks = set()
+        super().__init__(
+            server_port,
+            reuse_port=reuse_port,
+            load_processes=load_processes,
+            snapshot=snapshot,
+            watch_interval=watch_interval,
+            forwarder=forwarder,
+        )
+        self.dispatch = "asyncio"
+        # one thread per upstream socket, more would only wait for a socket
+        self.forward_executor = None
+        if forwarder is not None:
+            self.forward_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=forwarder.upstream.num_sockets,
+                thread_name_prefix="dns-forward",
+            )
+
+    def create_socket(self) -> None:
+        # the event loop binds the socket in serve()
+        return None
+
+    def spawn(self, coro) -> None:
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def serve(self) -> None:
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: DNSServerProtocol(self),
+            local_addr=self.server_address,
+            reuse_port=self.reuse_port or None,
+        )
+        try:
+            await asyncio.Future()  # serve until cancelled
+        finally:
+            transport.close()
+            if self.forward_executor is not None:
+                self.forward_executor.shutdown(wait=False, cancel_futures=True)
+
+    def run(self) -> None:
+        asyncio.run(self.serve())
 
-    server = Server(int(sys.argv[1]))
+    async def handle_query_async(self, incoming_message, client_address) -> None:
+        """
+        Coroutine version of handle_query, the simulated delay doesn't block the loop
+        """
+        try:
+            received_time = datetime.datetime.now()
+            try:
+                header, questions = parse_query(incoming_message)
+            except ValueError as e:
+                logging.error(f"Dropping malformed query from {client_address}: {e}")
+                return
+
+            if questions:
+                for question in questions:
+                    # simulate delay to test concurrency
+                    delay = random.randint(0, 4)
+                    self.log_received(
+                        received_time, client_address, header.qid, question, delay
+                    )
+
+                    await asyncio.sleep(delay)
+
+                    response = await self.process_query_async(header.qid, question)
+                    self.transport.sendto(response or b"", client_address)
+
+                    self.log_sent(client_address, header.qid, question)
+
+        except Exception as e:
+            logging.error(f"Error handling query: {e}")
+
+    async def process_query_async(
+        self, qid: int, question: DNSQuestion
+    ) -> bytes | None:
+        """
+        process_query without blocking the loop: a local answer is rendered right
+        away and only an upstream query waits in forward_executor.
+        """
+        entry = self.local_response(question)
+        if entry is None:
+            return None
+        if self.forwarder is not None and not entry.answered:
+            forwarded = await asyncio.get_running_loop().run_in_executor(
+                self.forward_executor, self.forwarder.forward, qid, question
+            )
+            if forwarded is not None:
+                return forwarded
+        return entry.render(qid, question)
+
+    def stats(self) -> dict:
+        stats = {
+            "dispatch": self.dispatch,
+            "responses": self.responses.stats(),
+            "pending": len(self.tasks),
+            "names": name_cache_stats(),
+        }
+        if self.forwarder is not None:
+            stats["forwarder"] = self.forwarder.stats()
+        return stats
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        usage="python3 server.py server_port [options]",
+    )
+    parser.add_argument("server_port", type=int)
+    parser.add_argument(
+        "--engine", choices=[ENGINE_THREADED, ENGINE_ASYNCIO], default=ENGINE_THREADED
+    )
+    parser.add_argument(
+        "--dispatch",
+        choices=[DISPATCH_THREAD, DISPATCH_POOL, DISPATCH_BATCH],
+        default=DISPATCH_THREAD,
+    )
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--pool-size", type=int, default=DEFAULT_POOL_SIZE)
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE)
+    parser.add_argument(
+        "--overflow", choices=[OVERFLOW_DROP, OVERFLOW_BLOCK], default=OVERFLOW_DROP
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--load-processes", type=int, default=1)
+    parser.add_argument("--snapshot", default=None)
+    parser.add_argument("--watch", type=float, default=0)
+    parser.add_argument("--forward", type=int, default=None, metavar="PORT")
+    parser.add_argument("--forward-sockets", type=int, default=DEFAULT_UPSTREAM_SOCKETS)
+    parser.add_argument("--forward-cache", type=int, default=DEFAULT_FORWARD_CACHE_SIZE)
+    parser.add_argument(
+        "--forward-ttl", type=float, default=DEFAULT_FORWARD_TTL, metavar="SECONDS"
+    )
+    return parser.parse_args(argv)
+
+
+def build_forwarder(args) -> Forwarder | None:
+    if args.forward is None:
+        return None
+    if args.forward == args.server_port:
+        sys.exit("Error: --forward must name another server's port.")
+    try:
+        return Forwarder(
+            args.forward,
+            num_sockets=args.forward_sockets,
+            cache_size=args.forward_cache,
+            ttl=args.forward_ttl,
+        )
+    except ValueError as e:
+        sys.exit(f"Error: {e}")
+
+
+def build_server(args, reuse_port: bool = False) -> Server:
+    forwarder = build_forwarder(args)
+    if args.engine == ENGINE_ASYNCIO:
+        return AsyncServer(
+            args.server_port,
+            reuse_port=reuse_port,
+            load_processes=args.load_processes,
+            snapshot=args.snapshot,
+            watch_interval=args.watch,
+            forwarder=forwarder,
+        )
+    if forwarder is not None and args.dispatch == DISPATCH_BATCH:
+        sys.exit("Error: --forward needs --dispatch thread or pool.")
+    try:
+        return Server(
+            args.server_port,
+            dispatch=args.dispatch,
+            pool_size=args.pool_size,
+            queue_size=args.queue_size,
+            overflow=args.overflow,
+            reuse_port=reuse_port,
+            batch_size=args.batch_size,
+            load_processes=args.load_processes,
+            snapshot=args.snapshot,
+            watch_interval=args.watch,
+            forwarder=forwarder,
+        )
+    except ValueError as e:
+        # e.g. a --pool-size or --queue-size below 1
+        sys.exit(f"Error: {e}")
+
+
+def serve(args, reuse_port: bool = False) -> None:
+    server = build_server(args, reuse_port)
+    server.enable_reload()
     try:
         server.run()
     except KeyboardInterrupt:
+        if server.dispatch != DISPATCH_THREAD:
+            print(f"\nServer stats: {server.stats()}")
         print("\nExiting...")
+
+
+def exit_code(e: SystemExit) -> int:
+    """
+    The status sys.exit(e.code) would end the process with, printing a message code.
+    """
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code, file=sys.stderr)
+    return 1
+
+
+def run_workers(args) -> int:
+    """
+    Fork args.workers processes that each bind the port with SO_REUSEPORT and
+    load the master file themselves, the kernel balances queries between them.
+
+    :return: 1 if any worker exited with an error, else 0.
+    """
+    if not hasattr(socket, "SO_REUSEPORT") or not hasattr(os, "fork"):
+        sys.exit("Error: --workers needs SO_REUSEPORT and fork support.")
+
+    children = []
+    for _ in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            # reset the parent's SIGTERM forwarding so workers stop normally
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # ignore reloads until this worker has a zone to reload
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            code = 0
+            try:
+                serve(args, reuse_port=True)
+            except SystemExit as e:
+                # e.g. the master file is missing, os._exit would lose the message
+                code = exit_code(e)
+            except BaseException as e:
+                logging.error(f"Worker {os.getpid()} failed: {e}")
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        children.append(pid)
+
+    def forward(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, forward)
+    # every worker holds its own zone, so each one reloads it
+    signal.signal(signal.SIGHUP, forward)
+
+    remaining = set(children)
+    failed = False
+
+    def wait_all():
+        nonlocal failed
+        while remaining:
+            pid, status = os.wait()  # whichever worker exits first
+            if pid not in remaining:
+                continue
+            remaining.discard(pid)
+            # a worker stopped by a signal was shut down, not failed
+            if os.waitstatus_to_exitcode(status) > 0 and not failed:
+                failed = True
+                # stop the rest rather than serve with fewer workers
+                for other in remaining:
+                    try:
+                        os.kill(other, signal.SIGTERM)
+                    except ProcessLookupError:
+                        pass
+
+    try:
+        wait_all()
+    except KeyboardInterrupt:
+        # the terminal already delivered SIGINT to every worker
+        wait_all()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+
+    if args.workers < 1:
+        sys.exit("Error: --workers must be at least 1.")
+    if args.workers > 1:
+        sys.exit(run_workers(args))
+    else:
+        serve(args)
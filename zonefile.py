@@ -0,0 +1,796 @@
+#! /usr/bin/env python3
+
+"""
+    Zone data for the DNS server: master file parsing, the record store and its indexes
+    Python 3
+    coding: utf-8
+
+    Notes:
+        Each line of the master file is "name type data", separated by whitespace.
+        Blank lines are skipped, and anything after a ";" or "#" is a comment.
+
+    Author: Fai Chan (z5411219)
+"""
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import List
+import logging
+import mmap
+import os
+import re
+import socket
+import struct
+import sys
+import time
+import zlib
+
+from classes import DNSRecord, TYPE_A, TYPE_CNAME, TYPE_NS
+
+CHUNK_SIZE = 8 * 1024 * 1024  # bytes parsed at a time
+
+# absolute ASCII names with no empty labels, they pack into wire format and back exactly
+PACKABLE_NAME = re.compile(r"(?:[\x21-\x2d\x2f-\x7e]{1,63}\.)+")
+
+LENGTH_BYTES = [bytes((length,)) for length in range(64)]
+
+MAX_CNAME_CHAIN = 16  # longer chains are reported and cut off at load time
+CNAME_FOLLOW_TYPES = ("A", "NS")  # the qtypes a CNAME is followed for
+
+COMMENT = re.compile(r"[;#].*")
+
+
+def parse_master_chunk(text: str) -> list:
+    """
+    Parse a piece of the master file made of whole lines.
+
+    :return: A list of (qname, qtype, record) tuples, in file order.
+    """
+    records = []
+    for line in COMMENT.sub("", text).splitlines():
+        fields = line.split()
+        if len(fields) == 3:
+            records.append((fields[0], fields[1], fields[2]))
+        elif fields:
+            logging.warning(f"Skipping malformed master file line: {line.strip()}")
+    return records
+
+
+def chunk_bounds(data, size: int, chunk_size: int) -> list:
+    """
+    Split data into (start, end) ranges of about chunk_size that end on a newline.
+    """
+    bounds = []
+    start = 0
+    while start < size:
+        end = min(start + chunk_size, size)
+        if end < size:
+            newline = data.find(b"\n", end)
+            end = size if newline == -1 else newline + 1
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+def parse_master_range(filename: str, start: int, end: int) -> list:
+    """
+    Parse bytes [start, end) of the master file, for a worker process.
+    """
+    with open(filename, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return parse_master_chunk(data[start:end].decode("utf-8"))
+
+
+def read_master_file(filename: str, processes: int = 1, chunk_size: int = CHUNK_SIZE):
+    """
+    Memory-map the master file and yield its records, chunk by chunk.
+
+    :param filename: The master file to read.
+    :param processes: Parse chunks in this many worker processes when more than 1,
+        results still come back in file order.
+    :param chunk_size: Roughly how many bytes each chunk holds.
+    """
+    size = os.path.getsize(filename)
+    if size == 0:
+        return
+
+    with open(filename, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if processes > 1:
+                # smaller chunks so every worker gets several
+                chunk_size = max(1, min(chunk_size, size // (processes * 4)))
+            bounds = chunk_bounds(data, size, chunk_size)
+
+            if processes <= 1 or len(bounds) == 1:
+                for start, end in bounds:
+                    yield from parse_master_chunk(data[start:end].decode("utf-8"))
+                return
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        starts = [start for start, _ in bounds]
+        ends = [end for _, end in bounds]
+        for records in executor.map(
+            parse_master_range, [filename] * len(bounds), starts, ends
+        ):
+            yield from records
+
+
+def pack_ipv4(address: str) -> bytes | None:
+    """
+    "192.0.2.1" -> 4 bytes, or None if it isn't a dotted-quad that round-trips exactly.
+    """
+    try:
+        packed = socket.inet_aton(address)
+    except OSError:
+        return None
+    # inet_aton also takes forms like "10.1" or "010.0.0.1"
+    return packed if socket.inet_ntoa(packed) == address else None
+
+
+def pack_name(name: str) -> bytes | None:
+    """
+    "ns1.example.com." -> wire format, or None if the text wouldn't decode back the same.
+    """
+    if name == ".":
+        return b"\x00"
+    if not PACKABLE_NAME.fullmatch(name):
+        return None
+    # the empty label after the final dot becomes the terminating zero byte
+    return b"".join(
+        LENGTH_BYTES[len(label)] + label for label in name.encode("ascii").split(b".")
+    )
+
+
+def unpack_names(packed: bytes) -> list:
+    """
+    Back-to-back wire-format names -> ["ns1.example.com.", ...]
+    """
+    names = []
+    text = bytearray(packed)
+    start = 0
+    offset = 0
+    while offset < len(packed):
+        length = packed[offset]
+        text[offset] = 0x2E  # "."
+        if length == 0:
+            names.append(text[start + 1 : offset + 1].decode("ascii") or ".")
+            start = offset + 1
+        offset += 1 + length
+    return names
+
+
+class ZoneEntry:
+    __slots__ = ("a", "ns", "cname", "other")
+
+    def __init__(self) -> None:
+        """
+        All the records owned by one name, packed into bytes.
+        """
+        self.a = b""  # 4 bytes per A record
+        self.ns = b""  # wire-format names, back to back
+        self.cname = b""
+        self.other = None  # qtype -> list of str, for anything that can't be packed
+
+    def add(self, qtype: str, record: str) -> None:
+        if self.other is None or qtype not in self.other:
+            if qtype == "A":
+                packed = pack_ipv4(record)
+                if packed is not None:
+                    self.a += packed
+                    return
+            elif qtype in ("NS", "CNAME"):
+                packed = pack_name(record)
+                if packed is not None:
+                    if qtype == "NS":
+                        self.ns += packed
+                    else:
+                        self.cname += packed
+                    return
+
+        if self.other is None:
+            self.other = {}
+        if qtype not in self.other:
+            # keep the records in order, move any packed ones of this type over too
+            self.other[qtype] = self.get(qtype, [])
+            if qtype == "A":
+                self.a = b""
+            elif qtype == "NS":
+                self.ns = b""
+            elif qtype == "CNAME":
+                self.cname = b""
+        self.other[qtype].append(record)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, ZoneEntry):
+            return NotImplemented
+        return (self.a, self.ns, self.cname, self.other) == (
+            other.a,
+            other.ns,
+            other.cname,
+            other.other,
+        )
+
+    def get(self, qtype: str, default=None) -> list:
+        """
+        The records of a type as text, in the order they were added.
+        """
+        records = []
+        if qtype == "A":
+            a = self.a
+            records = [
+                f"{a[i]}.{a[i + 1]}.{a[i + 2]}.{a[i + 3]}" for i in range(0, len(a), 4)
+            ]
+        elif qtype == "NS":
+            records = unpack_names(self.ns)
+        elif qtype == "CNAME":
+            records = unpack_names(self.cname)
+        if self.other is not None and qtype in self.other:
+            records = list(self.other[qtype])
+        return records or default
+
+    def has(self, qtype: str) -> bool:
+        if qtype == "A" and self.a or qtype == "NS" and self.ns:
+            return True
+        if qtype == "CNAME" and self.cname:
+            return True
+        return self.other is not None and qtype in self.other
+
+    def count(self) -> int:
+        qtypes = {"A", "NS", "CNAME"}.union(self.other or ())
+        return sum(len(self.get(qtype, [])) for qtype in qtypes)
+
+    def size(self) -> int:
+        # b"" is a shared singleton, only count blobs that hold records
+        size = sys.getsizeof(self) + sum(
+            sys.getsizeof(packed) for packed in (self.a, self.ns, self.cname) if packed
+        )
+        if self.other is not None:
+            size += sys.getsizeof(self.other)
+            for values in self.other.values():
+                size += sys.getsizeof(values) + sum(sys.getsizeof(v) for v in values)
+        return size
+
+
+class DNSCache:
+    def __init__(self):
+        self.cache = {}  # interned lowercased name -> ZoneEntry
+        # bumped on every change so derived caches can tell they are stale
+        self.version = 0
+
+    def get_cache(self):
+        return self.cache
+
+    def add_record(self, qname: str, qtype: str, record: str):
+        self.version += 1
+        qname = sys.intern(qname.lower())
+        entry = self.cache.get(qname)
+        if entry is None:
+            entry = self.cache[qname] = ZoneEntry()
+        entry.add(qtype, record)
+
+    def add_records(self, records) -> int:
+        """
+        Add many (qname, qtype, record) tuples at once.
+
+        :return: The number of records added.
+        """
+        cache = self.cache
+        count = 0
+        for qname, qtype, record in records:
+            qname = sys.intern(qname.lower())
+            entry = cache.get(qname)
+            if entry is None:
+                entry = cache[qname] = ZoneEntry()
+            entry.add(qtype, record)
+            count += 1
+        self.version += 1
+        return count
+
+    def get_records(self, qname: str, qtype: str) -> list:
+        entry = self.cache.get(qname.lower())
+        if entry is None:
+            return []
+        return entry.get(qtype, [])
+
+    def memory_usage(self) -> dict:
+        """
+        Approximate bytes held by the store: the dict, the names and the entries.
+        """
+        records = 0
+        size = sys.getsizeof(self.cache)
+        for qname, entry in self.cache.items():
+            size += sys.getsizeof(qname) + entry.size()
+            records += entry.count()
+        return {
+            "names": len(self.cache),
+            "records": records,
+            "bytes": size,
+            "bytes_per_record": size / records if records else 0.0,
+        }
+
+
+def changed_names(old: DNSCache, new: DNSCache) -> set:
+    """
+    The names whose records differ between two record stores, added and removed included.
+    """
+    old_cache = old.get_cache()
+    new_cache = new.get_cache()
+    changed = set(old_cache.keys() - new_cache.keys())
+    for qname, entry in new_cache.items():
+        if old_cache.get(qname) != entry:
+            changed.add(qname)
+    return changed
+
+
+@dataclass
+class CNAMEChain:
+    records: List[DNSRecord]  # the CNAME records followed, in order
+    terminal: str  # the name the chain stops at
+    answers: List[DNSRecord]  # records of the queried type at the terminal name
+
+
+class CNAMEIndex:
+    def __init__(self, max_length: int = MAX_CNAME_CHAIN) -> None:
+        """
+        Every CNAME chain in the zone, flattened once per qtype so a query
+        doesn't have to follow it one lookup at a time.
+
+        :param max_length: The most CNAME records a chain may have before it is cut off.
+        """
+        self.max_length = max_length
+        self.chains = {}
+        self.version = None  # the DNSCache version the chains were built from
+        # chain start -> the cycle or over-long chain it runs into
+        self.chain_problems = {}
+        # name -> the chain starts whose walk passes through it, may list a chain
+        # that no longer does, which only costs a needless recompute
+        self.dependents = {}
+
+    def build(self, cache: DNSCache) -> None:
+        chains = {}
+        problems = {}
+        dependents = {}
+        for qname, entry in list(cache.get_cache().items()):
+            names = self.add_chains(cache, qname, entry, chains, problems)
+            for name in names[1:]:
+                starts = dependents.get(name)
+                if starts is None:
+                    dependents[name] = [qname]
+                else:
+                    starts.append(qname)
+
+        self.chains = chains
+        self.chain_problems = problems
+        self.dependents = dependents
+        for problem in self.problems:
+            logging.warning(problem)
+        self.version = cache.version
+
+    def updated(self, cache: DNSCache, changed: set) -> "CNAMEIndex":
+        """
+        A copy of this index for cache, recomputing only the chains that start at or
+        pass through a changed name. The copy shares everything else with this index.
+
+        :param cache: The record store with the changes applied.
+        :param changed: The lowercased names whose records changed.
+        """
+        chains = dict(self.chains)
+        problems = dict(self.chain_problems)
+        dependents = dict(self.dependents)
+        old_problems = set(problems.values())
+
+        affected = set(changed)
+        for name in changed:
+            affected.update(self.dependents.get(name, ()))
+        for qname in affected:
+            for qtype in CNAME_FOLLOW_TYPES:
+                chains.pop((qname, qtype), None)
+            problems.pop(qname, None)
+
+        copied = set()  # dependents lists already copied, the old index keeps its own
+        store = cache.get_cache()
+        for qname in affected:
+            entry = store.get(qname)
+            if entry is None:
+                continue
+            names = self.add_chains(cache, qname, entry, chains, problems)
+            for name in names[1:]:
+                if name not in copied:
+                    dependents[name] = list(dependents.get(name, ()))
+                    copied.add(name)
+                if qname not in dependents[name]:
+                    dependents[name].append(qname)
+
+        index = CNAMEIndex(self.max_length)
+        index.chains = chains
+        index.chain_problems = problems
+        index.dependents = dependents
+        for problem in index.problems:
+            if problem not in old_problems:
+                logging.warning(problem)
+        index.version = cache.version
+        return index
+
+    def add_chains(
+        self,
+        cache: DNSCache,
+        qname: str,
+        entry: ZoneEntry,
+        chains: dict,
+        problems: dict,
+    ) -> list:
+        """
+        Flatten the chain starting at qname, for each qtype it would be followed for.
+
+        :return: The lowercased names the chain walked through, empty if there is no chain.
+        """
+        if not entry.has("CNAME"):
+            return []
+        qtypes = [qtype for qtype in CNAME_FOLLOW_TYPES if not entry.has(qtype)]
+        if not qtypes:
+            return []  # answered directly, the CNAME is never followed
+
+        # the hops don't depend on the qtype, only where the walk stops does
+        records, names, problem = self.follow(cache, qname)
+        for qtype in qtypes:
+            chains[(qname, qtype)], unresolved = self.stop(cache, records, names, qtype)
+            if unresolved and problem:
+                problems[qname] = problem
+        return [name.lower() for name in names]
+
+    @property
+    def problems(self) -> list:
+        # several chains can run into the same loop, report it once
+        return list(dict.fromkeys(self.chain_problems.values()))
+
+    def follow(self, cache: DNSCache, qname: str):
+        """
+        Follow the first CNAME of each name until there is none, it loops, or it's too long.
+
+        :return: The CNAME records, the names visited, and the problem found if any.
+        """
+        records = []
+        names = [qname]
+        seen = {qname.lower()}
+        while True:
+            cname_records = cache.get_records(qname, "CNAME")
+            if not cname_records:
+                return records, names, None
+            if len(records) == self.max_length:
+                return (
+                    records,
+                    names,
+                    f"CNAME chain from {records[0].name} is longer than {self.max_length} records",
+                )
+            target = cname_records[0]
+            records.append(DNSRecord(name=qname, type_=TYPE_CNAME, data=target))
+            if target.lower() in seen:
+                loop = [r.name.lower() for r in records]
+                loop = loop[loop.index(target.lower()) :]
+                # start from the smallest name so every entry into the loop reports it the same way
+                start = loop.index(min(loop))
+                loop = loop[start:] + loop[:start]
+                return records, names, f"CNAME loop: {' -> '.join(loop + loop[:1])}"
+            seen.add(target.lower())
+            names.append(target)
+            qname = target
+
+    def stop(self, cache: DNSCache, records: list, names: list, qtype: str):
+        """
+        Cut the chain at the first name that has records of qtype.
+
+        :return: The CNAMEChain, and whether the chain ran out without an answer.
+        """
+        type_ = TYPE_A if qtype == "A" else TYPE_NS
+        for i in range(1, len(names)):
+            answers = cache.get_records(names[i], qtype)
+            if answers:
+                chain = CNAMEChain(
+                    records=records[:i],
+                    terminal=names[i],
+                    answers=[
+                        DNSRecord(name=names[i], type_=type_, data=a) for a in answers
+                    ],
+                )
+                return chain, False
+        return CNAMEChain(records=records, terminal=names[-1], answers=[]), True
+
+    def get(self, qname: str, qtype: str) -> CNAMEChain | None:
+        return self.chains.get((qname.lower(), qtype))
+
+
+class DelegationNode:
+    __slots__ = ("children", "records")
+
+    def __init__(self) -> None:
+        self.children = {}  # next label towards the leaves -> DelegationNode
+        self.records = None  # NS records owned by this name, if any
+
+    def copy(self) -> "DelegationNode":
+        node = DelegationNode()
+        node.children = dict(self.children)
+        node.records = self.records
+        return node
+
+
+class NameserverIndex:
+    def __init__(self) -> None:
+        """
+        The NS records in the zone as a trie of reversed labels, so the closest
+        delegation for a name is found in one walk from the root.
+        """
+        self.root = DelegationNode()
+        self.version = None  # the DNSCache version the trie was built from
+
+    def build(self, cache: DNSCache) -> None:
+        root = DelegationNode()
+        for qname, entry in list(cache.get_cache().items()):
+            if not entry.has("NS"):
+                continue
+            ns_records = entry.get("NS")
+            node = root
+            for label in self.labels(qname):
+                child = node.children.get(label)
+                if child is None:
+                    child = node.children[label] = DelegationNode()
+                node = child
+            node.records = [
+                DNSRecord(name=qname, type_=TYPE_NS, data=ns) for ns in ns_records
+            ]
+        self.root = root
+        self.version = cache.version
+
+    def updated(self, cache: DNSCache, changed: set) -> "NameserverIndex":
+        """
+        A copy of this index for cache, only the paths to changed names are copied,
+        every other node is shared with this index.
+
+        :param cache: The record store with the changes applied.
+        :param changed: The lowercased names whose records changed.
+        """
+        store = cache.get_cache()
+        root = self.root.copy()
+        copied = {id(root)}
+        for qname in changed:
+            entry = store.get(qname)
+            records = None
+            if entry is not None and entry.has("NS"):
+                records = [
+                    DNSRecord(name=qname, type_=TYPE_NS, data=ns)
+                    for ns in entry.get("NS")
+                ]
+
+            node = root
+            for label in self.labels(qname):
+                child = node.children.get(label)
+                if child is None:
+                    if records is None:
+                        break  # never delegated, nothing to remove
+                    child = DelegationNode()
+                elif id(child) not in copied:
+                    child = child.copy()
+                else:
+                    node = child
+                    continue
+                copied.add(id(child))
+                node.children[label] = child
+                node = child
+            else:
+                node.records = records
+
+        index = NameserverIndex()
+        index.root = root
+        index.version = cache.version
+        return index
+
+    @staticmethod
+    def labels(qname: str):
+        # "www.example.com." -> "com", "example", "www"
+        return reversed([label for label in qname.lower().split(".") if label])
+
+    def find(self, qname: str) -> List[DNSRecord]:
+        node = self.root
+        closest = node.records
+        for label in self.labels(qname):
+            node = node.children.get(label)
+            if node is None:
+                break
+            if node.records:
+                closest = node.records
+        return list(closest) if closest else []
+
+
+# Snapshot layout, all integers little-endian:
+#   header   magic, format version, number of hash slots, number of entries
+#   slots    one u32 per slot, the file offset of an entry or 0 if empty
+#   entries  u16 key length, u32 value length, key, value
+# Keys are b"R" + name + b" " + qtype for record sets (records joined by newlines)
+# and b"C" + name + b" " + qtype for CNAME chains ("owner target" lines, then the
+# terminal name). Names are lowercased. Slots are probed linearly from crc32(key).
+SNAPSHOT_MAGIC = b"DNSZ"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sIII")
+SNAPSHOT_SLOT = struct.Struct("<I")
+SNAPSHOT_ENTRY = struct.Struct("<HI")
+
+
+def snapshot_entries(cache: DNSCache, cname_index: CNAMEIndex):
+    for qname, entry in cache.get_cache().items():
+        for qtype in {"A", "NS", "CNAME"}.union(entry.other or ()):
+            records = entry.get(qtype)
+            if records:
+                yield f"R{qname} {qtype}", "\n".join(records)
+    for (qname, qtype), chain in cname_index.chains.items():
+        lines = [f"{record.name} {record.data}" for record in chain.records]
+        lines.append(chain.terminal)
+        yield f"C{qname} {qtype}", "\n".join(lines)
+
+
+def write_snapshot(filename: str, cache: DNSCache, cname_index: CNAMEIndex) -> int:
+    """
+    Write the record store and CNAME index to a binary snapshot file.
+
+    :return: The number of entries written.
+    """
+    entries = [
+        (key.encode("utf-8"), value.encode("utf-8"))
+        for key, value in snapshot_entries(cache, cname_index)
+    ]
+    num_slots = 8
+    while num_slots < 2 * len(entries):
+        num_slots *= 2
+
+    slots = [0] * num_slots
+    body = bytearray()
+    offset = SNAPSHOT_HEADER.size + SNAPSHOT_SLOT.size * num_slots
+    for key, value in entries:
+        slot = zlib.crc32(key) & (num_slots - 1)
+        while slots[slot]:
+            slot = (slot + 1) & (num_slots - 1)
+        slots[slot] = offset + len(body)
+        body += SNAPSHOT_ENTRY.pack(len(key), len(value)) + key + value
+
+    # write beside the target and rename over it, a server may have the old file mapped
+    temp = f"{filename}.tmp"
+    with open(temp, "wb") as f:
+        f.write(
+            SNAPSHOT_HEADER.pack(
+                SNAPSHOT_MAGIC, SNAPSHOT_VERSION, num_slots, len(entries)
+            )
+        )
+        f.write(struct.pack(f"<{num_slots}I", *slots))
+        f.write(body)
+    os.replace(temp, filename)
+    return len(entries)
+
+
+def compile_snapshot(master_file: str, snapshot_file: str) -> int:
+    cache = DNSCache()
+    cache.add_records(read_master_file(master_file))
+    cname_index = CNAMEIndex()
+    cname_index.build(cache)
+    return write_snapshot(snapshot_file, cache, cname_index)
+
+
+class ZoneSnapshot:
+    def __init__(self, filename: str) -> None:
+        """
+        A compiled zone, memory-mapped and read in place.
+
+        :param filename: The snapshot written by write_snapshot.
+        """
+        with open(filename, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < SNAPSHOT_HEADER.size:
+            self.data.close()
+            raise ValueError(f"{filename} is too short to be a snapshot")
+        magic, version, self.num_slots, self.num_entries = SNAPSHOT_HEADER.unpack_from(
+            self.data, 0
+        )
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            self.data.close()
+            raise ValueError(f"{filename} is not a version {SNAPSHOT_VERSION} snapshot")
+        if len(self.data) < SNAPSHOT_HEADER.size + SNAPSHOT_SLOT.size * self.num_slots:
+            self.data.close()
+            raise ValueError(f"{filename} is truncated")
+
+        # stand-ins for DNSCache, CNAMEIndex and NameserverIndex, they never go stale
+        self.version = 0
+        self.cache = SnapshotCache(self)
+        self.cname_index = SnapshotCNAMEIndex(self)
+        self.ns_index = SnapshotNameserverIndex(self)
+
+    def lookup(self, key: bytes) -> bytes | None:
+        data = self.data
+        mask = self.num_slots - 1
+        slot = zlib.crc32(key) & mask
+        while True:
+            (offset,) = SNAPSHOT_SLOT.unpack_from(
+                data, SNAPSHOT_HEADER.size + SNAPSHOT_SLOT.size * slot
+            )
+            if offset == 0:
+                return None
+            key_length, value_length = SNAPSHOT_ENTRY.unpack_from(data, offset)
+            start = offset + SNAPSHOT_ENTRY.size
+            if key_length == len(key) and data[start : start + key_length] == key:
+                start += key_length
+                return data[start : start + value_length]
+            slot = (slot + 1) & mask
+
+    def get_records(self, qname: str, qtype: str) -> list:
+        value = self.lookup(f"R{qname.lower()} {qtype}".encode("utf-8"))
+        if value is None:
+            return []
+        return value.decode("utf-8").split("\n")
+
+    def close(self) -> None:
+        self.data.close()
+
+
+class SnapshotCache:
+    def __init__(self, snapshot: ZoneSnapshot) -> None:
+        self.snapshot = snapshot
+        self.version = snapshot.version
+
+    def get_records(self, qname: str, qtype: str) -> list:
+        return self.snapshot.get_records(qname, qtype)
+
+    def get_cache(self):
+        raise TypeError("A zone snapshot is read-only and can't be walked")
+
+
+class SnapshotCNAMEIndex:
+    def __init__(self, snapshot: ZoneSnapshot) -> None:
+        self.snapshot = snapshot
+        self.version = snapshot.version
+        self.problems = []  # reported when the snapshot was compiled
+
+    def get(self, qname: str, qtype: str) -> CNAMEChain | None:
+        value = self.snapshot.lookup(f"C{qname.lower()} {qtype}".encode("utf-8"))
+        if value is None:
+            return None
+        *lines, terminal = value.decode("utf-8").split("\n")
+        records = []
+        for line in lines:
+            name, target = line.split(" ")
+            records.append(DNSRecord(name=name, type_=TYPE_CNAME, data=target))
+        type_ = TYPE_A if qtype == "A" else TYPE_NS
+        answers = [
+            DNSRecord(name=terminal, type_=type_, data=answer)
+            for answer in self.snapshot.get_records(terminal, qtype)
+        ]
+        return CNAMEChain(records=records, terminal=terminal, answers=answers)
+
+
+class SnapshotNameserverIndex:
+    def __init__(self, snapshot: ZoneSnapshot) -> None:
+        self.snapshot = snapshot
+        self.version = snapshot.version
+
+    def find(self, qname: str) -> List[DNSRecord]:
+        qname = qname.lower()
+        if not qname.endswith("."):
+            qname += "."
+        # "www.example.com." then "example.com." then "com." then "."
+        start = 0
+        while True:
+            ancestor = qname[start:] or "."
+            ns_records = self.snapshot.get_records(ancestor, "NS")
+            if ns_records:
+                return [
+                    DNSRecord(name=ancestor, type_=TYPE_NS, data=ns)
+                    for ns in ns_records
+                ]
+            if ancestor == ".":
+                return []
+            start = qname.index(".", start) + 1
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit(f"Usage: {sys.argv[0]} master_file snapshot_file")
+
+    start = time.perf_counter()
+    count = compile_snapshot(sys.argv[1], sys.argv[2])
+    print(
+        f"Wrote {count} entries to {sys.argv[2]} in {time.perf_counter() - start:.3f}s"
+    )